@@ -0,0 +1,80 @@
+"""
+Compare bulk and streaming helpers with the naive ORM path on SQLite.
+
+    python benchmarks/db.py [ROWS]
+"""
+import os
+import sqlalchemy as sa
+import sys
+import tempfile
+import tracemalloc
+
+from mesh import Mesh
+from time import perf_counter
+
+
+def measure(name, func):
+    tracemalloc.start()
+    start = perf_counter()
+    func()
+    elapsed = perf_counter() - start
+    __, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f'{name:<16} {elapsed:8.3f} s {peak / 2**20:8.1f} MiB')
+
+
+def main(count):
+    directory = tempfile.mkdtemp()
+    mesh = Mesh({'DB_DSN': f"sqlite:///{os.path.join(directory, 'bench.db')}"})
+    db = mesh.init_db()
+
+    class Item(db.Model):
+        __tablename__ = 'item'
+        id = sa.Column(sa.Integer, primary_key=True)
+        name = sa.Column(sa.String)
+
+    db.Model.metadata.create_all(db.engine)
+    rows = [{'id': id, 'name': f'item {id}'} for id in range(count)]
+
+    def reset():
+        with mesh.make_context():
+            db.session.execute(Item.__table__.delete())
+            db.session.commit()
+
+    def orm_insert():
+        with mesh.make_context():
+            for row in rows:
+                db.session.add(Item(**row))
+            db.session.commit()
+
+    def bulk_insert():
+        with mesh.make_context():
+            db.bulk_insert(Item, rows)
+            db.session.commit()
+
+    def bulk_upsert():
+        with mesh.make_context():
+            db.bulk_upsert(Item, rows)
+            db.session.commit()
+
+    def orm_read():
+        with mesh.make_context():
+            for item in Item.query.all():
+                pass
+
+    def stream_read():
+        with mesh.make_context():
+            for item in Item.query.stream(1000):
+                pass
+
+    reset()
+    measure('orm insert', orm_insert)
+    reset()
+    measure('bulk insert', bulk_insert)
+    measure('bulk upsert', bulk_upsert)
+    measure('orm read', orm_read)
+    measure('stream read', stream_read)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -1,6 +1,12 @@
 import logging
 
 from os import environ
+from threading import local
+
+try:
+    from contextvars import ContextVar
+except ImportError:
+    ContextVar = None
 
 
 class Config:
@@ -24,6 +30,20 @@ class Config:
         else:
             return default
 
+    def int(self, key, default):
+        text = self.get(key)
+        if text is not None:
+            return int(text)
+        else:
+            return default
+
+    def float(self, key, default):
+        text = self.get(key)
+        if text is not None:
+            return float(text)
+        else:
+            return default
+
 
 class MeshBase:
 
@@ -35,7 +55,10 @@ class MeshBase:
         self.http = None
         self.influx = None
         self.logger = None
+        self.metrics = None
+        self.profiler = None
         self.sentry = None
+        self.tracer = None
 
     def init_amqp(self):
         if self.amqp is None and 'AMQP_DSN' in self.config:
@@ -43,6 +66,12 @@ class MeshBase:
             self.amqp = AMQP(self)
         return self.amqp
 
+    def init_async_amqp(self):
+        if self.amqp is None and 'AMQP_DSN' in self.config:
+            from mesh.aio import AsyncAMQP
+            self.amqp = AsyncAMQP(self)
+        return self.amqp
+
     def init_cron(self):
         if self.cron is None:
             from mesh.cron import CRON
@@ -61,6 +90,68 @@ class MeshBase:
             self.influx = Influx(self)
         return self.influx
 
+    def init_metrics(self):
+        if self.metrics is None:
+            from mesh.metrics import Registry
+            self.metrics = Registry()
+            port = self.config.int('METRICS_PORT', None)
+            if port is not None:
+                self.metrics.serve(port)
+        return self.metrics
+
+    def init_profiler(self):
+        if self.profiler is None:
+            from mesh.profiler import Profiler
+            self.profiler = Profiler(self)
+        return self.profiler
+
+    def init_trace(self):
+        if self.tracer is None and 'TRACE_SINK' in self.config:
+            from mesh.trace import Tracer
+            self.tracer = Tracer(self)
+        return self.tracer
+
+    def describe_context(self, context):
+        return (
+            getattr(context, 'method', None),
+            getattr(context, 'path', None),
+            context_headers(context))
+
+    def after_fork(self, worker=0):
+        if self.metrics is not None:
+            self.metrics.after_fork(worker)
+        if self.amqp is not None:
+            self.amqp.after_fork()
+        if self.tracer is not None:
+            self.tracer.after_fork()
+        if self.profiler is not None:
+            self.profiler.after_fork()
+        if self.influx is not None:
+            self.influx.after_fork()
+        if self.http is not None:
+            self.http.after_fork()
+        if self.db is not None:
+            engines = [self.db.engine, *getattr(self.db, 'replicas', ())]
+            for engine in engines:
+                try:
+                    engine.dispose(close=False)
+                except TypeError:
+                    engine.dispose()
+
+    def close(self):
+        # Worker processes leave with os._exit, which skips the atexit
+        # handlers of the components.
+        if self.amqp is not None:
+            self.amqp.close()
+        if self.tracer is not None:
+            self.tracer.close()
+        if self.influx is not None:
+            self.influx.close()
+        if self.profiler is not None:
+            self.profiler.close()
+        if self.metrics is not None:
+            self.metrics.close()
+
     def init_sentry(self):
         if self.sentry is None and 'SENTRY_DSN' in self.config:
             from mesh.sentry import make_client
@@ -74,7 +165,8 @@ class Mesh(MeshBase):
 
     def __init__(self, config=None):
         super().__init__(config)
-        self.context = None
+        self.context_var = make_context_var('mesh.context')
+        self.setup_callbacks = []
         self.teardown_callbacks = []
 
     def init_db(self):
@@ -96,6 +188,10 @@ class Mesh(MeshBase):
                 sentry.install_logging_hook()
         return self.sentry
 
+    def setup_context(self, callback):
+        self.setup_callbacks.append(callback)
+        return callback
+
     def teardown_context(self, callback):
         self.teardown_callbacks.append(callback)
         return callback
@@ -104,23 +200,70 @@ class Mesh(MeshBase):
         return Context(self, kwargs)
 
     def current_context(self):
-        return self.context
+        return self.context_var.get()
 
 
 class Context:
 
     def __init__(self, mesh, attrs):
         self.mesh = mesh
+        self.tokens = []
         for key, value in attrs.items():
             setattr(self, key, value)
 
     def __enter__(self):
-        self.mesh.context = self
+        self.tokens.append(self.mesh.context_var.set(self))
+        for callback in self.mesh.setup_callbacks:
+            callback()
+        return self
 
     def __exit__(self, exc_type, exc_value, traceback):
-        if exc_type is not None:
-            self.mesh.logger.exception('Exception occured')
-        for callback in self.mesh.teardown_callbacks:
-            callback()
-        self.mesh.context = None
+        try:
+            if exc_type is not None:
+                self.mesh.logger.exception('Exception occured')
+            for callback in self.mesh.teardown_callbacks:
+                callback()
+        finally:
+            self.mesh.context_var.reset(self.tokens.pop())
         return True
+
+
+def context_headers(context):
+    # Trace headers of consumed messages are application headers, not
+    # message properties.
+    message = getattr(context, 'amqp_message', None)
+    if message is None:
+        messages = getattr(context, 'amqp_messages', None)
+        message = messages[0] if messages else None
+    if message is not None:
+        return message.headers
+    return getattr(context, 'headers', None)
+
+
+class ThreadContextVar:
+
+    # Fallback for Python 3.6, which lacks contextvars. Values are
+    # local to threads only, not to asyncio tasks.
+
+    def __init__(self, name, default=None):
+        self.name = name
+        self.default = default
+        self.local = local()
+
+    def get(self):
+        return getattr(self.local, 'value', self.default)
+
+    def set(self, value):
+        token = self.get()
+        self.local.value = value
+        return token
+
+    def reset(self, token):
+        self.local.value = token
+
+
+def make_context_var(name):
+    if ContextVar is not None:
+        return ContextVar(name, default=None)
+    else:
+        return ThreadContextVar(name)
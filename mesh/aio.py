@@ -0,0 +1,197 @@
+import asyncio
+import contextvars
+import inspect
+import socket
+
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from signal import SIGINT, SIGTERM
+
+from mesh.amqp import AMQP, Reply
+
+
+class AsyncAMQP(AMQP):
+
+    # Kombu has no asyncio transport, so broker I/O runs on a single
+    # thread per connection while tasks and reply waiters are
+    # coroutines on the event loop. Replies are resolved by the pump
+    # thread of their link.
+
+    def __init__(self, mesh):
+        # Set before the pool is made.
+        self.concurrency = mesh.config.int('AMQP_CONCURRENCY', 100)
+        super().__init__(mesh)
+        # Messages beyond the concurrency would only wait for the
+        # semaphore in memory.
+        self.prefetch_count = mesh.config.int(
+            'AMQP_PREFETCH_COUNT', self.concurrency)
+        self.loop = None
+        self.semaphore = None
+        self.io = ThreadPoolExecutor(1, thread_name_prefix='amqp-io')
+
+    def make_pool(self):
+        # Every task may hold a session, so tasks never wait for each
+        # other to release one.
+        pool = super().make_pool()
+        pool.size = max(pool.size, self.concurrency)
+        return pool
+
+    @property
+    def session(self):
+        # Sessions are awaited, because acquiring one may wait for the
+        # pool or open a channel.
+        return self.acquire_async_session()
+
+    async def acquire_async_session(self):
+        context = self.mesh.current_context()
+        async_session = getattr(context, 'amqp_async_session', None)
+        session = getattr(context, 'amqp_session', None)
+        if session is None:
+            session = await self.call(self.acquire_session)
+        if async_session is None or async_session.session is not session:
+            async_session = AsyncSession(self, session)
+            setattr(context, 'amqp_async_session', async_session)
+        return async_session
+
+    @property
+    def concurrent(self):
+        return True
+
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        self.running = True
+        self.loop.add_signal_handler(SIGINT, self.stop)
+        self.loop.add_signal_handler(SIGTERM, self.stop)
+
+        if self.outbox is not None:
+            self.outbox.start()
+
+        await self.loop.run_in_executor(self.io, self.consume)
+        while self.running:
+            await self.loop.run_in_executor(self.io, self.drain_events)
+        await self.loop.run_in_executor(self.io, self.shutdown)
+
+    def dispatch(self, func, *args):
+        # Called on the I/O thread.
+        future = asyncio.run_coroutine_threadsafe(
+            self.limit(func, *args), self.loop)
+        self.futures.add(future)
+
+    async def limit(self, func, *args):
+        async with self.semaphore:
+            await func(*args)
+
+    async def call(self, func, *args, **kwargs):
+        # Blocking calls run on the default executor with the current
+        # context, so that they see the current Mesh context.
+        loop = asyncio.get_running_loop()
+        context = contextvars.copy_context()
+        return await loop.run_in_executor(
+            None, partial(context.run, func, *args, **kwargs))
+
+    async def invoke(self, callback, argument):
+        result = callback(argument)
+        if inspect.isawaitable(result):
+            result = await result
+        return result
+
+    async def handle_message(self, consumer_name, message_type, message):
+        with self.make_message_context(consumer_name, message_type, message):
+            try:
+                task = self.tasks[consumer_name, message_type]
+                fresh = await self.dedup_call(self.fresh, task, [message])
+                if fresh:
+                    await self.invoke(task.callback, message)
+                    await self.dedup_call(self.mark, task, fresh)
+            except Exception:
+                self.logger.exception('Exception occured')
+                await self.call(
+                    self.fail, self.tasks.get((consumer_name, message_type)),
+                    message)
+            else:
+                if not message.acknowledged:
+                    message.ack()
+
+        self.forget(consumer_name, [message])
+
+    async def handle_batch(self, task, messages):
+        split = task.on_error == 'split' and len(messages) > 1
+        failed = False
+        with self.make_batch_context(task, messages):
+            try:
+                fresh = await self.dedup_call(self.fresh, task, messages)
+                if fresh:
+                    await self.invoke(task.callback, fresh)
+                    await self.dedup_call(self.mark, task, fresh)
+            except Exception:
+                self.logger.exception('Exception occured')
+                failed = True
+                if not split:
+                    await self.call(self.fail_batch, task, messages)
+            else:
+                self.ack_batch(task.consumer_name, messages)
+
+        if failed and split:
+            for message in messages:
+                await self.handle_batch(task, [message])
+        else:
+            self.forget(task.consumer_name, messages)
+
+    async def dedup_call(self, func, task, messages):
+        # Dedup backends query a database, the in-memory cache does not.
+        if task.idempotent and self.dedup.backend is not None:
+            return await self.call(func, task, messages)
+        return func(task, messages)
+
+
+class AsyncSession:
+
+    def __init__(self, amqp, session):
+        self.amqp = amqp
+        self.session = session
+
+    def add(self, **kwargs):
+        self.session.add(**kwargs)
+
+    async def commit(self):
+        await self.amqp.call(self.session.commit)
+
+    def rollback(self):
+        self.session.rollback()
+
+    async def publish(self, prepared_message=None, **kwargs):
+        result = await self.amqp.call(
+            self.session.publish, prepared_message, **kwargs)
+        if isinstance(result, Reply):
+            return asyncio.wrap_future(result)
+        return result
+
+    async def request(self, timeout=None, **kwargs):
+        kwargs.setdefault('reply_to', self.session.reply_queue)
+        reply = await self.amqp.call(self.session.publish, **kwargs)
+        return (await self.gather([reply], timeout))[0]
+
+    async def request_many(self, messages, timeout=None):
+        messages = [dict(kwargs, reply_to=self.session.reply_queue)
+                    for kwargs in messages]
+        replies = await self.amqp.call(
+            lambda: [self.session.publish(**kwargs) for kwargs in messages])
+        return await self.gather(replies, timeout, strict=False)
+
+    async def gather(self, replies, timeout, strict=True):
+        futures = [asyncio.wrap_future(reply) for reply in replies]
+        await asyncio.wait(futures, timeout=timeout or 10)
+        results = []
+        for reply, future in zip(replies, futures):
+            if future.done() and not future.cancelled():
+                results.append(future.result())
+                continue
+            self.session.discard(reply)
+            if strict:
+                raise socket.timeout('Timed out waiting for reply')
+            results.append(None)
+        return results
+
+    async def respond(self, **kwargs):
+        return await self.amqp.call(self.session.respond, **kwargs)
@@ -1,14 +1,45 @@
 import atexit
+import random
 import socket
 
-from kombu import Connection, Exchange, Queue
+from collections import defaultdict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import wait as wait_futures
+from functools import partial
+from kombu import Connection, Consumer, Exchange, Producer, Queue
+from kombu import compression
 from kombu.common import uuid
+from kombu.exceptions import MessageStateError
+from kombu.serialization import dumps
+from select import select
 from signal import SIGINT, SIGTERM, signal
-from threading import Lock
+from threading import Condition, Lock, RLock, Thread
+from time import monotonic, sleep
+
+from mesh import metrics, trace
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import lz4.frame
+except ImportError:
+    pass
+else:
+    compression.register(
+        lz4.frame.compress,
+        lz4.frame.decompress,
+        'application/x-lz4',
+        aliases=['lz4'])
 
 
 class AMQP:
 
+    poll_interval = 0.01
+    delay_queue_expires = 3600
+
     def __init__(self, mesh):
         self.mesh = mesh
         self.logger = mesh.init_logger()
@@ -17,37 +48,72 @@ class AMQP:
         self.base_url = 'amqp://{}/'.format(self.app_id or '')
         self.connection_prototype = Connection(mesh.config['AMQP_DSN'])
 
-        self.sessions = []
-        self.mutex = Lock()
+        self.pool = self.make_pool()
 
-        self.task_callbacks = {}
+        self.tasks = {}
+        self.dedup = None
         self.connection = None
         self.consumers = {}
+        self.prefetch_counts = {}
         self.running = False
 
+        self.accept = ('json', 'pickle')
+        self.serializer = mesh.config.get('AMQP_SERIALIZER', 'json')
+        if msgpack is not None:
+            self.accept += ('msgpack',)
+        elif self.serializer == 'msgpack':
+            self.logger.warning('msgpack is not installed, using json')
+            self.serializer = 'json'
+        self.compression = mesh.config.get('AMQP_COMPRESSION')
+        self.compression_threshold = mesh.config.int(
+            'AMQP_COMPRESSION_THRESHOLD', 1024)
+
+        self.confirm = mesh.config.bool('AMQP_CONFIRM', False)
+        self.confirm_timeout = mesh.config.float('AMQP_CONFIRM_TIMEOUT', 10)
+
+        self.outbox = None
+        if mesh.config.bool('AMQP_OUTBOX', False):
+            from mesh.outbox import Outbox
+            self.outbox = Outbox(self, mesh.init_db())
+
+        self.workers = mesh.config.int('AMQP_WORKERS', 0)
+        self.prefetch_count = mesh.config.int(
+            'AMQP_PREFETCH_COUNT', self.workers or None)
+        self.executor = None
+        self.futures = set()
+        self.actions = deque()
+        self.generation = 0
+        self.delivered = defaultdict(dict)
+        self.declared = {}
+        self.mutex = Lock()
+
+        self.max_messages = mesh.config.int('AMQP_MAX_MESSAGES', 0)
+        self.processed = 0
+
         mesh.teardown_context(self.release_session)
         atexit.register(self.close)
 
     def close(self):
-        while self.sessions:
-            session = self.sessions.pop()
-            session.close()
+        if self.outbox is not None:
+            self.outbox.close()
+        self.pool.close()
         for consumer in self.consumers.values():
             consumer.close()
         if self.connection is not None:
             self.connection.close()
 
+    def make_pool(self):
+        return Pool(self)
+
     @property
     def session(self):
+        return self.acquire_session()
+
+    def acquire_session(self):
         context = self.mesh.current_context()
         session = getattr(context, 'amqp_session', None)
         if session is None:
-            with self.mutex:
-                try:
-                    session = self.sessions.pop()
-                except IndexError:
-                    connection = self.connection_prototype.clone()
-                    session = Session(self.mesh, self.app_id, connection)
+            session = self.pool.acquire()
             session.begin()
             setattr(context, 'amqp_session', session)
         return session
@@ -57,16 +123,49 @@ class AMQP:
         session = getattr(context, 'amqp_session', None)
         if session is not None:
             session.rollback()
-            if session.connected:
-                with self.mutex:
-                    self.sessions.append(session)
+            self.pool.release(session)
+            setattr(context, 'amqp_session', None)
+
+    def task(self, message_type, consumer_name='default', batch_size=None,
+             max_wait=1000, on_error='reject', retry=None, idempotent=False):
+        if idempotent:
+            self.init_dedup()
 
-    def task(self, message_type, consumer_name='default'):
         def decorator(callback):
-            self.task_callbacks[consumer_name, message_type] = callback
+            self.tasks[consumer_name, message_type] = Task(
+                consumer_name, message_type, callback,
+                batch_size=batch_size,
+                max_wait=max_wait,
+                on_error=on_error,
+                retry=retry,
+                idempotent=idempotent)
             return callback
         return decorator
 
+    def after_fork(self):
+        # Connections inherited from the parent process are dropped
+        # without closing them, which would close them for the parent.
+        self.pool = self.make_pool()
+        self.generation += 1
+        self.actions.clear()
+        self.futures.clear()
+        self.delivered.clear()
+        self.declared.clear()
+        self.processed = 0
+        if self.outbox is not None:
+            self.outbox.after_fork()
+        if self.connection is not None:
+            self.connection = None
+            connection = self.init_connection()
+            for consumer in self.consumers.values():
+                consumer.revive(connection.channel())
+
+    def init_dedup(self):
+        if self.dedup is None:
+            from mesh.dedup import Dedup
+            self.dedup = Dedup(self.mesh)
+        return self.dedup
+
     def init_connection(self):
         connection = self.connection
         if connection is None:
@@ -75,14 +174,21 @@ class AMQP:
             self.connection = connection
         return connection
 
-    def init_consumer(self, consumer_name='default'):
+    def init_consumer(self, consumer_name='default', prefetch_count=None):
         consumer = self.consumers.get(consumer_name)
         if consumer is None:
             connection = self.init_connection()
-            consumer = connection.Consumer(
-                accept=('json', 'pickle'),
+            if prefetch_count is None:
+                prefetch_count = self.prefetch_count
+            self.prefetch_counts[consumer_name] = prefetch_count
+            # Each consumer gets its own channel, so that prefetch
+            # limits apply per consumer.
+            consumer = Consumer(
+                connection.channel(),
+                accept=self.accept,
                 on_message=self.process_message,
                 tag_prefix=f'{consumer_name}/',
+                prefetch_count=prefetch_count,
                 auto_declare=False)
             self.consumers[consumer_name] = consumer
         return consumer
@@ -98,28 +204,189 @@ class AMQP:
         signal(SIGINT, self.stop)
         signal(SIGTERM, self.stop)
 
-        for consumer in self.consumers.values():
-            consumer.consume()
+        if self.outbox is not None:
+            self.outbox.start()
 
+        if self.workers > 0:
+            self.executor = ThreadPoolExecutor(
+                self.workers, thread_name_prefix='amqp')
+
+        self.consume()
         while self.running:
-            try:
-                self.connection.drain_events(timeout=5)
-            except socket.timeout:
-                self.connection.heartbeat_check()
-            except self.connection.connection_errors:
-                self.connection.close()
-                self.connection.ensure_connection(max_retries=3)
-                for consumer in self.consumers.values():
-                    consumer.revive(self.connection)
-                    consumer.consume()
+            self.drain_events()
+
+        self.shutdown()
+
+    def consume(self):
+        for consumer_name, consumer in self.consumers.items():
+            # Batches only fill up to the prefetch count, so batch
+            # consumers get room for their largest batch on top.
+            sizes = [task.batch_size for task in self.tasks.values()
+                     if task.consumer_name == consumer_name and
+                     task.batch_size is not None]
+            prefetch_count = self.prefetch_counts[consumer_name]
+            if sizes and prefetch_count is not None:
+                consumer.prefetch_count = prefetch_count + max(sizes)
+                consumer.qos(prefetch_count=consumer.prefetch_count)
+            consumer.consume()
 
     def stop(self, signo=None, frame=None):
         self.running = False
 
+    def shutdown(self):
+        # Stop receiving new messages, but let workers finish those
+        # already delivered so that their acks reach the broker.
+        try:
+            for consumer in self.consumers.values():
+                consumer.cancel()
+        except self.connection.connection_errors:
+            pass
+        for task in self.tasks.values():
+            if task.batch:
+                self.flush_batch(task)
+        while self.futures:
+            self.drain_events()
+        # Inline batches and workers that finished after the last
+        # drain leave their acks queued.
+        self.settle()
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def drain_events(self):
+        timeout = self.poll_interval if self.futures else 5
+        now = monotonic()
+        for task in self.tasks.values():
+            if task.batch:
+                timeout = max(min(timeout, task.deadline - now), 0)
+        try:
+            self.connection.drain_events(timeout=timeout)
+        except socket.timeout:
+            self.connection.heartbeat_check()
+        except self.connection.connection_errors:
+            self.reconnect()
+        now = monotonic()
+        for task in self.tasks.values():
+            if task.batch and task.deadline <= now:
+                self.flush_batch(task)
+        self.settle()
+
+    def reconnect(self):
+        # Unacknowledged messages are redelivered by the broker, so
+        # pending acks for the old channels are discarded.
+        self.generation += 1
+        self.actions.clear()
+        with self.mutex:
+            self.delivered.clear()
+        for task in self.tasks.values():
+            task.batch.clear()
+        self.connection.close()
+        self.connection.ensure_connection(max_retries=3)
+        for consumer in self.consumers.values():
+            consumer.revive(self.connection.channel())
+            consumer.consume()
+
+    def settle(self):
+        while self.actions:
+            generation, action = self.actions.popleft()
+            if generation != self.generation:
+                continue
+            try:
+                action()
+            except self.connection.connection_errors:
+                self.reconnect()
+        self.futures = {f for f in self.futures if not f.done()}
+
     def process_message(self, message):
         consumer_name, __, __ = message.delivery_info['consumer_tag'].partition('/')  # noqa
         message_type = message.properties.get('type')
+        task = self.tasks.get((consumer_name, message_type))
 
+        if self.mesh.metrics is not None:
+            self.mesh.metrics.counter(
+                'mesh_amqp_messages_total', 'Consumed AMQP messages',
+                ('consumer', 'type'),
+            ).inc(consumer_name, message_type)
+
+        # Let a supervisor replace this process after a number of
+        # messages, which caps memory growth.
+        self.processed += 1
+        if self.max_messages and self.processed >= self.max_messages:
+            self.stop()
+
+        batch = task is not None and task.batch_size is not None
+        if self.concurrent or batch:
+            message = Delivery(self, message)
+        with self.mutex:
+            self.delivered[consumer_name][message.delivery_tag] = message
+
+        if batch:
+            if not task.batch:
+                task.deadline = monotonic() + task.max_wait
+            task.batch.append(message)
+            if len(task.batch) >= task.batch_size:
+                self.flush_batch(task)
+        else:
+            self.dispatch(
+                self.handle_message, consumer_name, message_type, message)
+
+    @property
+    def concurrent(self):
+        return self.executor is not None
+
+    def dispatch(self, func, *args):
+        if self.executor is None:
+            func(*args)
+        else:
+            self.futures.add(self.executor.submit(func, *args))
+
+    def flush_batch(self, task):
+        messages = list(task.batch)
+        task.batch.clear()
+        self.dispatch(self.handle_batch, task, messages)
+
+    def handle_message(self, consumer_name, message_type, message):
+        with self.make_message_context(consumer_name, message_type, message):
+            try:
+                task = self.tasks[consumer_name, message_type]
+                fresh = self.fresh(task, [message])
+                if fresh:
+                    task.callback(message)
+                    self.mark(task, fresh)
+            except Exception:
+                self.logger.exception('Exception occured')
+                self.fail(self.tasks.get((consumer_name, message_type)),
+                          message)
+            else:
+                if not message.acknowledged:
+                    message.ack()
+
+        self.forget(consumer_name, [message])
+
+    def handle_batch(self, task, messages):
+        split = task.on_error == 'split' and len(messages) > 1
+        failed = False
+        with self.make_batch_context(task, messages):
+            try:
+                fresh = self.fresh(task, messages)
+                if fresh:
+                    task.callback(fresh)
+                    self.mark(task, fresh)
+            except Exception:
+                self.logger.exception('Exception occured')
+                failed = True
+                if not split:
+                    self.fail_batch(task, messages)
+            else:
+                self.ack_batch(task.consumer_name, messages)
+
+        if failed and split:
+            for message in messages:
+                self.handle_batch(task, [message])
+        else:
+            self.forget(task.consumer_name, messages)
+
+    def make_message_context(self, consumer_name, message_type, message):
         context = self.mesh.make_context(
             method='CONSUME',
             base_url=self.base_url,
@@ -128,71 +395,530 @@ class AMQP:
             content_type=message.content_type,
             data=message.body)
         context.amqp_message = message
+        return context
+
+    def make_batch_context(self, task, messages):
+        context = self.mesh.make_context(
+            method='CONSUME',
+            base_url=self.base_url,
+            path=f'/{task.consumer_name}/{task.message_type}')
+        context.amqp_messages = messages
+        return context
+
+    def fresh(self, task, messages):
+        # Skips messages that an idempotent task processed already.
+        if not task.idempotent:
+            return messages
+        return [message for message in messages
+                if not self.dedup.seen(message.properties.get('message_id'))]
 
-        with context:
+    def mark(self, task, messages):
+        if task.idempotent:
+            for message in messages:
+                self.dedup.mark(message.properties.get('message_id'))
+
+    def fail_batch(self, task, messages):
+        requeue = task.on_error == 'requeue'
+        for message in messages:
+            self.fail(task, message, requeue=requeue)
+
+    def fail(self, task, message, requeue=False):
+        if message.acknowledged:
+            return
+        if task is not None and task.retry is not None:
             try:
-                callback = self.task_callbacks[consumer_name, message_type]
-                callback(message)
+                if self.retry(task, message):
+                    return
             except Exception:
-                self.logger.exception('Exception occured')
-                if not message.acknowledged:
-                    message.reject()
+                self.logger.exception('Retry failed')
+        message.reject(requeue=requeue)
+
+    def retry(self, task, message):
+        # Failed messages are republished to a delay queue, which
+        # dead-letters them back to the original queue once their TTL
+        # expires. The number of attempts is counted in a header.
+        queue_name = self.queue_name(task.consumer_name, message)
+        if queue_name is None:
+            return False
+
+        policy = task.retry
+        headers = dict(message.headers or {})
+        headers.pop('compression', None)
+        attempts = int(headers.get(policy.header, 0)) + 1
+        headers[policy.header] = attempts
+
+        if attempts < policy.attempts:
+            delay = policy.delay(attempts)
+            queue = Queue(
+                '{}.retry.{}'.format(queue_name, int(delay * 1000)),
+                durable=True,
+                queue_arguments={
+                    'x-message-ttl': int(delay * 1000),
+                    'x-dead-letter-exchange': '',
+                    'x-dead-letter-routing-key': queue_name,
+                    # Delay queues left unused are deleted by the broker.
+                    'x-expires': int(
+                        (delay + self.delay_queue_expires) * 1000),
+                })
+            expiration = policy.jitter(delay)
+        elif policy.dead_letter is not None:
+            queue = Queue(policy.dead_letter, durable=True)
+            expiration = None
+        else:
+            return False
+
+        session = self.acquire_session()
+        # Queues are declared again well before they could expire.
+        declared = self.declared.get(queue.name)
+        if (declared is None or
+                monotonic() - declared > self.delay_queue_expires / 2):
+            session.declare(queue)
+            self.declared[queue.name] = monotonic()
+
+        properties = message.properties
+        prepared_message = {
+            'exchange': '',
+            'routing_key': queue.name,
+            'body': message.body,
+            'content_type': message.content_type,
+            'content_encoding': message.content_encoding,
+            'headers': headers,
+            'expiration': expiration,
+            'reply_to': properties.get('reply_to'),
+            'correlation_id': properties.get('correlation_id'),
+            'message_id': properties.get('message_id'),
+            'type': properties.get('type'),
+            'app_id': properties.get('app_id'),
+            'delivery_mode': properties.get('delivery_mode', 2),
+        }
+        if self.confirm:
+            try:
+                session.publish_confirmed([prepared_message])
+            except PublishError:
+                # The message is rejected instead, so it must not be
+                # sent again when the session revives.
+                session.failed.remove(prepared_message)
+                raise
+        else:
+            session.publish(prepared_message)
+        message.ack()
+        return True
+
+    def queue_name(self, consumer_name, message):
+        consumer = self.consumers[consumer_name]
+        consumer_tag = message.delivery_info['consumer_tag']
+        for name, tag in list(consumer._active_tags.items()):
+            if tag == consumer_tag:
+                return name
+
+    def ack_batch(self, consumer_name, messages):
+        unacked = [message for message in messages
+                   if not message.acknowledged]
+        if not unacked:
+            return
+        last = max(unacked, key=lambda message: message.delivery_tag)
+        tags = {message.delivery_tag for message in unacked}
+
+        with self.mutex:
+            # A multiple ack covers every delivery up to the last tag
+            # on the channel, so it is only safe when no other message
+            # below that tag is still waiting for acknowledgement.
+            delivered = self.delivered[consumer_name]
+            outstanding = [
+                tag for tag, message in delivered.items()
+                if tag <= last.delivery_tag and not message.acknowledged]
+            if tags.issuperset(outstanding):
+                last.ack(multiple=True)
+                for message in unacked:
+                    message.acknowledged = True
             else:
-                if not message.acknowledged:
+                for message in unacked:
                     message.ack()
+            for tag in [tag for tag, message in delivered.items()
+                        if message.acknowledged]:
+                del delivered[tag]
+
+    def forget(self, consumer_name, messages):
+        with self.mutex:
+            delivered = self.delivered[consumer_name]
+            for message in messages:
+                delivered.pop(message.delivery_tag, None)
+
+
+class Task:
+
+    def __init__(self, consumer_name, message_type, callback, batch_size,
+                 max_wait, on_error, retry, idempotent):
+        assert on_error in ('reject', 'requeue', 'split')
+        self.consumer_name = consumer_name
+        self.message_type = message_type
+        self.callback = callback
+        self.batch_size = batch_size
+        self.max_wait = max_wait / 1000
+        self.on_error = on_error
+        self.retry = retry
+        self.idempotent = idempotent
+        self.batch = []
+        self.deadline = None
+
+
+class Retry:
+
+    header = 'x-mesh-attempts'
+
+    def __init__(self, attempts=5, delay=1, factor=2, max_delay=300,
+                 jitter=0.1, dead_letter=None):
+        self.attempts = attempts
+        self.initial_delay = delay
+        self.factor = factor
+        self.max_delay = max_delay
+        self.jitter_ratio = jitter
+        self.dead_letter = dead_letter
+
+    def delay(self, attempt):
+        delay = self.initial_delay * self.factor ** (attempt - 1)
+        return min(delay, self.max_delay)
+
+    def jitter(self, delay):
+        # Per-message TTL can only shorten the delay queue TTL, so the
+        # jitter is subtracted.
+        if not self.jitter_ratio:
+            return None
+        return delay * (1 - self.jitter_ratio * random.random())
+
+
+class Delivery:
+
+    # Kombu channels are not thread safe, so workers only record
+    # acknowledgements and the connection thread sends them.
+
+    def __init__(self, amqp, message):
+        self.amqp = amqp
+        self.message = message
+        self.generation = amqp.generation
+        self.acknowledged = False
+
+    def __getattr__(self, name):
+        return getattr(self.message, name)
+
+    def ack(self, multiple=False):
+        self.settle(partial(self.message.ack, multiple=multiple))
+
+    def reject(self, requeue=False):
+        self.settle(partial(self.message.reject, requeue=requeue))
+
+    def requeue(self):
+        self.settle(self.message.requeue)
+
+    def settle(self, action):
+        if self.acknowledged:
+            raise MessageStateError('Message already acknowledged')
+        # Queue the action before flagging the message, so that a
+        # multiple ack from another worker never overtakes it.
+        self.amqp.actions.append((self.generation, action))
+        self.acknowledged = True
+
+
+class Pool:
+
+    # Sessions are channels multiplexed over a few shared connections.
+
+    def __init__(self, amqp):
+        config = amqp.mesh.config
+        self.amqp = amqp
+        self.size = config.int('AMQP_POOL_SIZE', 32)
+        self.timeout = config.float('AMQP_POOL_TIMEOUT', 30)
+        self.idle_timeout = config.float('AMQP_POOL_IDLE_TIMEOUT', 300)
+        self.links = [
+            Link(amqp.connection_prototype.clone())
+            for __ in range(config.int('AMQP_POOL_CONNECTIONS', 1))
+        ]
+        self.idle = deque()
+        self.in_use = 0
+        self.condition = Condition()
+        self.created = 0
+        self.evicted = 0
+        self.waits = 0
+        self.wait_time = 0.0
+
+    def acquire(self, timeout=None):
+        if timeout is None:
+            timeout = self.timeout
+        started = monotonic()
+        deadline = started + timeout
+        with self.condition:
+            while True:
+                self.evict()
+                while self.idle:
+                    __, session = self.idle.pop()
+                    if session.connected:
+                        self.in_use += 1
+                        self.record_wait(started)
+                        return session
+                    self.discard(session)
+                if self.in_use < self.size:
+                    self.in_use += 1
+                    link = self.choose_link()
+                    link.sessions += 1
+                    break
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    raise TimeoutError('AMQP session pool exhausted')
+                self.condition.wait(remaining)
+            self.record_wait(started)
+
+        try:
+            session = Session(self.amqp, link)
+        except Exception:
+            with self.condition:
+                self.in_use -= 1
+                link.sessions -= 1
+                self.condition.notify()
+            raise
+
+        with self.condition:
+            self.created += 1
+        return session
+
+    def choose_link(self):
+        return min(self.links, key=lambda link: link.sessions)
+
+    def release(self, session):
+        with self.condition:
+            self.in_use -= 1
+            if session.connected:
+                self.idle.append((monotonic(), session))
+            else:
+                self.discard(session)
+            self.evict()
+            self.condition.notify()
+
+    def record_wait(self, started):
+        elapsed = monotonic() - started
+        if elapsed > 0.001:
+            self.waits += 1
+            self.wait_time += elapsed
+
+    def evict(self):
+        threshold = monotonic() - self.idle_timeout
+        while self.idle and self.idle[0][0] < threshold:
+            __, session = self.idle.popleft()
+            self.discard(session)
+            self.evicted += 1
+
+    def discard(self, session):
+        session.link.sessions -= 1
+        session.close()
+
+    def close(self):
+        with self.condition:
+            while self.idle:
+                __, session = self.idle.pop()
+                self.discard(session)
+        for link in self.links:
+            link.close()
+
+    def stats(self):
+        with self.condition:
+            return {
+                'in_use': self.in_use,
+                'idle': len(self.idle),
+                'size': self.size,
+                'connections': sum(
+                    1 for link in self.links if link.connection.connected),
+                'created': self.created,
+                'evicted': self.evicted,
+                'waits': self.waits,
+                'wait_time': self.wait_time,
+            }
+
+
+class Link:
+
+    # Kombu connections are not thread safe, so every use of a shared
+    # connection holds its lock. Replies and publisher confirms arrive
+    # on the shared connection, so a pump thread drains it while any
+    # of them is awaited. It waits for data without the lock, so that
+    # publishes are not held up meanwhile.
+
+    drain_interval = 0.05
+    poll_interval = 0.01
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.lock = RLock()
+        self.generation = 0
+        self.sessions = 0
+        self.watched = set()
+        self.pumping = False
+        self.watch_mutex = Lock()
+
+    def channel(self):
+        with self.lock:
+            self.connection.ensure_connection(max_retries=3)
+            return self.generation, self.connection.channel()
+
+    def revive(self, generation):
+        with self.lock:
+            # Another session may have reconnected already.
+            if generation == self.generation:
+                self.generation += 1
+                self.connection.close()
+            self.connection.ensure_connection(max_retries=3)
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def watch(self, future):
+        with self.watch_mutex:
+            self.watched.add(future)
+            start = not self.pumping
+            self.pumping = True
+        if start:
+            Thread(target=self.pump, name='amqp-pump', daemon=True).start()
+        return future
+
+    def pump(self):
+        while True:
+            with self.watch_mutex:
+                self.watched.difference_update(
+                    [future for future in self.watched if future.done()])
+                if not self.watched:
+                    self.pumping = False
+                    return
+            timeout = self.wait()
+            if timeout is None:
+                continue
+            with self.lock:
+                try:
+                    self.connection.drain_events(timeout=timeout)
+                except socket.timeout:
+                    pass
+                except self.connection.connection_errors as exc:
+                    # Direct reply queues are tied to channels, so
+                    # replies in flight are lost with the connection.
+                    with self.watch_mutex:
+                        watched, self.watched = self.watched, set()
+                        self.pumping = False
+                    for future in watched:
+                        if not future.done():
+                            future.set_exception(exc)
+                    return
+
+    def wait(self):
+        # Returns the timeout to drain with once there may be events,
+        # or None.
+        sock = None
+        if self.connection.connected:
+            sock = getattr(self.connection.connection, 'sock', None)
+        if sock is None:
+            # Virtual transports are polled without blocking.
+            sleep(self.poll_interval)
+            return 0
+        try:
+            readable, __, __ = select([sock], [], [], self.drain_interval)
+        except (OSError, ValueError):
+            # Closed sockets fail in drain_events.
+            return 0
+        return self.drain_interval if readable else None
 
 
 class Session:
 
     reply_queue = Queue('amq.rabbitmq.reply-to')
 
-    def __init__(self, mesh, app_id, connection):
-        self.mesh = mesh
-        self.app_id = app_id
-        self.connection = connection
+    def __init__(self, amqp, link, confirm=None):
+        self.mesh = amqp.mesh
+        self.outbox = amqp.outbox
+        self.app_id = amqp.app_id
+        self.accept = amqp.accept
+        self.serializer = amqp.serializer
+        self.compression = amqp.compression
+        self.compression_threshold = amqp.compression_threshold
+        self.confirm = amqp.confirm if confirm is None else confirm
+        self.confirm_timeout = amqp.confirm_timeout
+        self.link = link
+        self.connection = link.connection
         self.producer = None
         self.consumer = None
         self.new = []
         self.pending = []
+        self.failed = []
         self.replies = {}
+        self.confirms = {}
+        self.confirmed = None
+        self.nacked = []
+        self.open_channel()
+
+    def open_channel(self):
+        self.generation, self.channel = self.link.channel()
+        self.delivery_tag = 0
+        if self.confirm:
+            with self.link.lock:
+                self.channel.confirm_select()
+                self.channel.events['basic_ack'].add(self.process_ack)
+                self.channel.events['basic_nack'].add(self.process_nack)
 
     def init_producer(self):
         if self.producer is None:
-            self.producer = self.connection.Producer()
+            self.producer = Producer(self.channel)
 
     def init_consumer(self):
         if self.consumer is None:
-            self.consumer = self.connection.Consumer(
-                queues=[self.reply_queue],
-                accept=('json', 'pickle'),
-                on_message=self.process_reply,
-                no_ack=True)
-            self.consumer.consume()
+            with self.link.lock:
+                self.consumer = Consumer(
+                    self.channel,
+                    queues=[self.reply_queue],
+                    accept=self.accept,
+                    on_message=self.process_reply,
+                    no_ack=True)
+                self.consumer.consume()
 
     @property
     def connected(self):
-        return self.connection.connected
+        return (self.generation == self.link.generation and
+                self.connection.connected and
+                getattr(self.channel, 'is_open', True))
 
     def revive(self):
-        self.connection.close()
-        self.connection.ensure_connection(max_retries=3)
-        if self.producer is not None:
-            self.producer.revive(self.connection)
-        if self.consumer is not None:
-            self.consumer.revive(self.connection)
-            self.consumer.consume()
+        self.link.revive(self.generation)
+        self.open_channel()
+        with self.link.lock:
+            if self.producer is not None:
+                self.producer.revive(self.channel)
+            if self.consumer is not None:
+                self.consumer.revive(self.channel)
+                self.consumer.consume()
+        if self.failed:
+            failed, self.failed = self.failed, []
+            self.publish_confirmed(failed)
+
+    def declare(self, entity):
+        with self.link.lock:
+            entity(self.channel).declare()
 
     def close(self):
-        if self.consumer is not None:
-            self.consumer.close()
-        if self.producer is not None:
-            self.producer.close()
-        self.connection.close()
+        if self.generation != self.link.generation:
+            return
+        with self.link.lock:
+            try:
+                if self.consumer is not None:
+                    self.consumer.close()
+                self.channel.close()
+            except self.connection.connection_errors:
+                pass
 
     def begin(self):
         self.new.clear()
         self.pending.clear()
-        self.replies.clear()
+        self.failed.clear()
+        self.cancel_replies()
+
+    def cancel_replies(self):
+        while self.replies:
+            __, reply = self.replies.popitem()
+            reply.cancel()
 
     def add(self, **kwargs):
         self.new.append(kwargs)
@@ -204,15 +930,55 @@ class Session:
         self.new.clear()
 
     def commit(self):
-        if self.new:
-            self.flush()
-        for prepared_message in self.pending:
-            self.publish(prepared_message)
-        self.pending.clear()
+        with metrics.timer(self.mesh, 'mesh_amqp_commit_seconds',
+                           'AMQP session commit latency'):
+            if self.outbox is not None:
+                self.outbox.commit()
+                return
+            if self.new:
+                self.flush()
+            if self.confirm:
+                pending, self.pending = self.pending, []
+                self.publish_confirmed(pending)
+            else:
+                for prepared_message in self.pending:
+                    self.publish(prepared_message)
+                self.pending.clear()
 
     def rollback(self):
         self.new.clear()
         self.pending.clear()
+        self.failed.clear()
+
+    def publish_confirmed(self, prepared_messages):
+        # Publish the whole batch first and then wait once for all
+        # broker confirms. Messages which are nacked, unconfirmed in
+        # time or lost with the connection are kept for revive().
+        if not prepared_messages:
+            return
+        deadline = self.deadline(self.confirm_timeout)
+        self.confirms.clear()
+        self.nacked.clear()
+        self.confirmed = Future()
+        unsent = list(prepared_messages)
+        try:
+            with self.link.lock:
+                while unsent:
+                    self.send(unsent[0])
+                    self.confirms[self.delivery_tag] = unsent.pop(0)
+            self.link.watch(self.confirmed)
+            wait_futures([self.confirmed], deadline - monotonic())
+        except self.connection.connection_errors:
+            pass
+        with self.link.lock:
+            failed = self.nacked + list(self.confirms.values()) + unsent
+            self.confirms.clear()
+            self.nacked.clear()
+            self.confirmed.cancel()
+            self.confirmed = None
+        if failed:
+            self.failed.extend(failed)
+            raise PublishError(failed)
 
     def prepare(self, *, exchange=None, routing_key=None, reply_to=None,
                 correlation_id=None, body=None, json=None, persistent=True,
@@ -237,8 +1003,11 @@ class Session:
             assert body is None
             if callable(json):
                 json = json()
-            kwargs['serializer'] = 'json'
-            kwargs['body'] = json
+            serializer = kwargs.pop('serializer', self.serializer)
+            content_type, content_encoding, body = dumps(json, serializer)
+            kwargs['content_type'] = content_type
+            kwargs['content_encoding'] = content_encoding
+            kwargs['body'] = body
         else:
             if callable(body):
                 body = body()
@@ -246,51 +1015,93 @@ class Session:
                 body = ''
             kwargs['body'] = body
 
+        if (self.compression is not None and
+                isinstance(kwargs['body'], (bytes, str)) and
+                len(kwargs['body']) >= self.compression_threshold):
+            kwargs.setdefault('compression', self.compression)
+
+        if self.mesh.tracer is not None:
+            kwargs['headers'] = self.mesh.tracer.inject(
+                dict(kwargs.get('headers') or {}))
+
         return kwargs
 
     def publish(self, prepared_message=None, **kwargs):
-        if prepared_message is None:
-            prepared_message = self.prepare(**kwargs)
+        with trace.span(self.mesh, 'publish', 'amqp') as span:
+            if prepared_message is None:
+                prepared_message = self.prepare(**kwargs)
+            if span is not None:
+                span.tags['routing_key'] = prepared_message['routing_key']
+
+            try:
+                reply = self.send(prepared_message)
+            except self.connection.connection_errors:
+                self.revive()
+                reply = self.send(prepared_message)
+
+        if reply is not None:
+            return reply
+        return prepared_message['correlation_id']
 
+    def send(self, prepared_message):
         self.init_producer()
+        reply = None
         if prepared_message['reply_to'] == self.reply_queue.name:
             self.init_consumer()
+            correlation_id = prepared_message['correlation_id']
+            reply = self.replies[correlation_id] = Reply(self, correlation_id)
 
-        try:
-            self.producer.publish(**prepared_message)
-        except self.connection.connection_errors:
-            self.revive()
+        with self.link.lock:
             self.producer.publish(**prepared_message)
+            if self.confirm:
+                self.delivery_tag += 1
 
-        return prepared_message['correlation_id']
+        if reply is not None:
+            self.link.watch(reply)
+        return reply
 
     def wait(self, correlation_id, timeout=None):
+        if isinstance(correlation_id, Reply):
+            reply = correlation_id
+        else:
+            reply = self.replies[correlation_id]
+        wait_futures([reply], self.deadline(timeout) - monotonic())
+        if not reply.done():
+            self.discard(reply)
+            raise socket.timeout('Timed out waiting for reply')
+        return Future.result(reply)
+
+    def deadline(self, timeout):
         if timeout is None:
             timeout = 10
+        return monotonic() + timeout
 
-        elapsed = 0
-        while True:
-            reply = self.replies.pop(correlation_id, None)
-            if reply is not None:
-                return reply
-
-            try:
-                self.connection.drain_events(timeout=1)
-            except socket.timeout:
-                elapsed += 1
-                if elapsed >= timeout:
-                    raise
-            except self.connection.connection_errors:
-                # There is no point in retrying. Direct reply queues
-                # are tied to connections, so we couldn't receive
-                # replies anyway.
-                self.close()
-                raise
+    def discard(self, reply):
+        self.replies.pop(reply.correlation_id, None)
+        reply.cancel()
 
     def request(self, timeout=None, **kwargs):
-        kwargs.setdefault('reply_to', self.reply_queue)
-        correlation_id = self.publish(**kwargs)
-        return self.wait(correlation_id, timeout=timeout)
+        with trace.span(self.mesh, 'request', 'amqp'):
+            kwargs.setdefault('reply_to', self.reply_queue)
+            reply = self.publish(**kwargs)
+            return self.wait(reply, timeout=timeout)
+
+    def request_many(self, messages, timeout=None):
+        deadline = self.deadline(timeout)
+        replies = []
+        with trace.span(self.mesh, 'request_many', 'amqp'):
+            for kwargs in messages:
+                kwargs = dict(kwargs, reply_to=self.reply_queue)
+                replies.append(self.publish(**kwargs))
+            wait_futures(replies, deadline - monotonic())
+        results = []
+        for reply in replies:
+            if reply.done():
+                results.append(Future.result(reply))
+            else:
+                self.discard(reply)
+                results.append(None)
+        return results
 
     def respond(self, **kwargs):
         context = self.mesh.current_context()
@@ -301,5 +1112,43 @@ class Session:
 
     def process_reply(self, message):
         correlation_id = message.properties['correlation_id']
-        if correlation_id is not None:
-            self.replies[correlation_id] = message
+        reply = self.replies.pop(correlation_id, None)
+        if reply is not None and not reply.cancelled():
+            reply.set_result(message)
+
+    def process_ack(self, delivery_tag, multiple):
+        self.resolve_confirms(delivery_tag, multiple)
+
+    def process_nack(self, delivery_tag, multiple):
+        self.nacked.extend(self.resolve_confirms(delivery_tag, multiple))
+
+    def resolve_confirms(self, delivery_tag, multiple):
+        # Confirm callbacks run while the connection lock is held.
+        if multiple:
+            tags = [tag for tag in self.confirms if tag <= delivery_tag]
+        else:
+            tags = [delivery_tag]
+        messages = [self.confirms.pop(tag) for tag in tags
+                    if tag in self.confirms]
+        if not self.confirms and self.confirmed is not None:
+            if not self.confirmed.done():
+                self.confirmed.set_result(None)
+        return messages
+
+
+class PublishError(Exception):
+
+    def __init__(self, messages):
+        super().__init__('{} messages not confirmed'.format(len(messages)))
+        self.messages = messages
+
+
+class Reply(Future):
+
+    def __init__(self, session, correlation_id):
+        super().__init__()
+        self.session = session
+        self.correlation_id = correlation_id
+
+    def result(self, timeout=None):
+        return self.session.wait(self, timeout=timeout)
@@ -0,0 +1,73 @@
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+
+
+class LRUCache:
+
+    def __init__(self, maxsize, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, key):
+        return self.get(key, self) is not self
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                expires, value = self.data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            if expires is not None and expires <= monotonic():
+                del self.data[key]
+                self.misses += 1
+                return default
+            self.data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        expires = monotonic() + ttl if ttl is not None else None
+        with self.lock:
+            self.data[key] = (expires, value)
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def discard(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+
+    def discard_if(self, predicate):
+        with self.lock:
+            for key in [key for key, (__, value) in self.data.items()
+                        if predicate(key, value)]:
+                del self.data[key]
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def values(self):
+        with self.lock:
+            return [value for __, value in self.data.values()]
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self.data),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / lookups if lookups else 0.0,
+        }
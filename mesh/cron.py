@@ -1,8 +1,14 @@
+import heapq
+import random
 import re
 
-from schedule import Scheduler as BaseScheduler
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from itertools import count
 from signal import signal, SIGINT, SIGTERM
-from time import sleep
+from threading import Event, Lock
+
+from mesh import metrics
 
 
 class CRON:
@@ -14,19 +20,25 @@ class CRON:
         self.logger = mesh.init_logger()
         self.running = False
 
-    def task(self, when):
+    def task(self, when, overlap='skip', catchup='once', jitter=0,
+             lease=False):
         def decorator(func):
             match = self.pattern.match(when)
-            interval = match.group(1)
-            if interval is not None:
-                job = self.scheduler.every(int(interval))
+            if match is not None:
+                interval = match.group(1)
+                trigger = Interval(
+                    int(interval) if interval is not None else 1,
+                    match.group(2),
+                    match.group(3),
+                    aligned=lease)
             else:
-                job = self.scheduler.every()
-            getattr(job, match.group(2))
-            time_str = match.group(3)
-            if time_str is not None:
-                job.at(time_str)
-            job.do(func)
+                trigger = Crontab(when)
+            self.scheduler.add(Job(
+                func, trigger,
+                overlap=overlap,
+                catchup=catchup,
+                jitter=jitter,
+                lease=lease))
             return func
         return decorator
 
@@ -37,24 +49,328 @@ class CRON:
 
         while self.running:
             self.scheduler.run_pending()
-            sleep(self.scheduler.idle_seconds)
+            self.scheduler.wakeup.wait(self.scheduler.idle_seconds)
+            self.scheduler.wakeup.clear()
+
+        self.scheduler.shutdown()
 
     def stop(self, signo=None, frame=None):
         self.running = False
+        self.scheduler.wakeup.set()
+
 
+class Scheduler:
 
-class Scheduler(BaseScheduler):
+    # Jobs are kept in a heap ordered by their next fire time, so only
+    # due jobs are touched, and run on a bounded thread pool.
+
+    max_idle_seconds = 60
+    max_backlog = 100
 
     def __init__(self, mesh):
-        super().__init__()
         self.mesh = mesh
+        self.workers = mesh.config.int('CRON_WORKERS', 4)
+        self.misfire_grace = mesh.config.float('CRON_MISFIRE_GRACE', 1)
+        self.executor = None
+        self.lease = None
+        self.heap = []
+        self.sequence = count()
+        self.lock = Lock()
+        self.wakeup = Event()
+
+    @property
+    def jobs(self):
+        return [job for __, __, job, __ in self.heap]
+
+    @property
+    def idle_seconds(self):
+        with self.lock:
+            if not self.heap:
+                return self.max_idle_seconds
+            seconds = (self.heap[0][0] - datetime.now()).total_seconds()
+        return min(max(seconds, 0), self.max_idle_seconds)
+
+    def add(self, job, now=None):
+        if now is None:
+            now = datetime.now()
+        self.schedule(job, job.trigger.next(now))
+
+    def schedule(self, job, fire_time):
+        due = fire_time
+        if job.jitter:
+            due += timedelta(seconds=random.uniform(0, job.jitter))
+        with self.lock:
+            entry = (due, next(self.sequence), job, fire_time)
+            heapq.heappush(self.heap, entry)
+        self.wakeup.set()
+
+    def run_pending(self, now=None):
+        if now is None:
+            now = datetime.now()
+        due = []
+        with self.lock:
+            while self.heap and self.heap[0][0] <= now:
+                __, __, job, fire_time = heapq.heappop(self.heap)
+                due.append((job, fire_time))
+
+        for job, fire_time in due:
+            firings, next_time = self.catch_up(job, fire_time, now)
+            if not firings:
+                self.mesh.logger.info('Skipped missed run of %s', job.name)
+            for fire_time in firings:
+                self.submit(job, fire_time)
+            self.schedule(job, next_time)
 
-    def _run_job(self, job):
+    def catch_up(self, job, fire_time, now):
+        next_time = job.trigger.next(fire_time)
+        if next_time > now:
+            late = now - fire_time > timedelta(seconds=self.misfire_grace)
+            if late and job.catchup == 'skip':
+                return [], next_time
+            return [fire_time], next_time
+        if job.catchup != 'all':
+            firings = [fire_time] if job.catchup == 'once' else []
+            return firings, job.trigger.next(now)
+        firings = [fire_time]
+        while next_time <= now and len(firings) < self.max_backlog:
+            firings.append(next_time)
+            next_time = job.trigger.next(next_time)
+        if next_time <= now:
+            next_time = job.trigger.next(now)
+        return firings, next_time
+
+    def submit(self, job, fire_time):
+        with job.lock:
+            if job.running and job.overlap == 'skip':
+                return
+            if job.running and job.overlap == 'queue':
+                if len(job.queued) < self.max_backlog:
+                    job.queued.append(fire_time)
+                return
+            job.running += 1
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(
+                self.workers, thread_name_prefix='cron')
+        self.executor.submit(self.execute, job, fire_time)
+
+    def execute(self, job, fire_time):
+        while fire_time is not None:
+            try:
+                self._run_job(job, fire_time)
+            finally:
+                with job.lock:
+                    if job.queued:
+                        fire_time = job.queued.pop(0)
+                    else:
+                        job.running -= 1
+                        fire_time = None
+
+    def init_lease(self):
+        if self.lease is None:
+            from mesh.lease import Lease
+            db = self.mesh.init_db()
+            if db is None:
+                raise RuntimeError('Cron leases require DB_DSN')
+            self.lease = Lease(self.mesh, db)
+        return self.lease
+
+    def _run_job(self, job, fire_time):
+        if job.lease and not self.init_lease().acquire(job.name, fire_time):
+            return
         context = self.mesh.make_context(
             method='CRON',
-            path=job.job_func.__name__)
-        with context:
+            path=job.name)
+        timer = metrics.timer(
+            self.mesh, 'mesh_cron_job_seconds', 'Cron job duration',
+            job=job.name, status='ok')
+        with context, timer:
             try:
-                super()._run_job(job)
+                job.func()
             except Exception:
                 self.mesh.logger.exception('Exception occured')
+                timer.labels['status'] = 'error'
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+
+class Job:
+
+    def __init__(self, func, trigger, overlap='skip', catchup='once',
+                 jitter=0, lease=False):
+        assert overlap in ('skip', 'queue', 'allow')
+        assert catchup in ('skip', 'once', 'all')
+        self.func = func
+        self.name = func.__name__
+        self.trigger = trigger
+        self.overlap = overlap
+        self.catchup = catchup
+        self.jitter = jitter
+        self.lease = lease
+        self.lock = Lock()
+        self.running = 0
+        self.queued = []
+
+
+class Interval:
+
+    units = {
+        'second': timedelta(seconds=1),
+        'minute': timedelta(minutes=1),
+        'hour': timedelta(hours=1),
+        'day': timedelta(days=1),
+        'week': timedelta(weeks=1),
+    }
+
+    weekdays = ('monday', 'tuesday', 'wednesday', 'thursday', 'friday',
+                'saturday', 'sunday')
+
+    epoch = datetime(1970, 1, 1)
+
+    def __init__(self, interval, unit, at=None, aligned=False):
+        if unit in self.weekdays:
+            self.weekday = self.weekdays.index(unit)
+            self.period = interval * self.units['week']
+        else:
+            self.weekday = None
+            unit = unit.rstrip('s')
+            self.period = interval * self.units[unit]
+        self.hourly = unit == 'hour'
+        if at is not None:
+            if unit in ('second', 'minute'):
+                raise ValueError(f'Interval of {unit}s cannot start at {at}')
+            hour, minute = at.split(':')
+            # Hourly tasks only take the minute, as in schedule.
+            self.at = (0 if self.hourly else int(hour), int(minute))
+        elif self.weekday is not None:
+            self.at = (0, 0)
+        else:
+            self.at = None
+        # Aligned intervals fire at the same times on every replica.
+        self.aligned = aligned
+        self.anchor = None
+
+    def next(self, after):
+        if self.anchor is None:
+            self.anchor = self.first(after)
+            return self.anchor
+        if after < self.anchor:
+            return self.anchor
+        periods = (after - self.anchor) // self.period + 1
+        return self.anchor + periods * self.period
+
+    def first(self, now):
+        if self.aligned:
+            # Count periods from the first matching time after the epoch
+            # rather than from the replica's start date.
+            anchor = self.epoch
+            if self.at is not None:
+                hour, minute = self.at
+                anchor += timedelta(hours=hour, minutes=minute)
+            if self.weekday is not None:
+                anchor += timedelta(days=(self.weekday - anchor.weekday()) % 7)
+            periods = (now - anchor) // self.period + 1
+            return anchor + periods * self.period
+        if self.at is None:
+            return now + self.period
+        hour, minute = self.at
+        if self.hourly:
+            first = now.replace(minute=minute, second=0, microsecond=0)
+            if first <= now:
+                first += timedelta(hours=1)
+            return first
+        first = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+        if self.weekday is not None:
+            first += timedelta(days=(self.weekday - first.weekday()) % 7)
+            if first <= now:
+                first += timedelta(weeks=1)
+        elif first <= now:
+            first += timedelta(days=1)
+        return first
+
+
+class Crontab:
+
+    aliases = {
+        '@yearly': '0 0 1 1 *',
+        '@annually': '0 0 1 1 *',
+        '@monthly': '0 0 1 * *',
+        '@weekly': '0 0 * * 0',
+        '@daily': '0 0 * * *',
+        '@midnight': '0 0 * * *',
+        '@hourly': '0 * * * *',
+    }
+
+    months = ('jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep',
+              'oct', 'nov', 'dec')
+
+    days = ('sun', 'mon', 'tue', 'wed', 'thu', 'fri', 'sat')
+
+    def __init__(self, expression):
+        fields = self.aliases.get(expression, expression).split()
+        if len(fields) != 5:
+            raise ValueError(f'Invalid crontab expression: {expression}')
+        self.minutes = self.parse(fields[0], 0, 59)
+        self.hours = self.parse(fields[1], 0, 23)
+        self.days_of_month = self.parse(fields[2], 1, 31)
+        self.months_of_year = self.parse(fields[3], 1, 12, self.months, 1)
+        days_of_week = self.parse(fields[4], 0, 7, self.days, 0)
+        # Both 0 and 7 are Sunday; Python numbers Monday as 0.
+        self.days_of_week = {(day - 1) % 7 for day in days_of_week}
+        self.any_day_of_month = fields[2] == '*'
+        self.any_day_of_week = fields[4] == '*'
+
+    @staticmethod
+    def parse(field, low, high, names=(), offset=0):
+        values = set()
+        for part in field.lower().split(','):
+            value_range, __, step = part.partition('/')
+            if value_range == '*':
+                start, end = low, high
+            else:
+                start, __, end = value_range.partition('-')
+                start = Crontab.value(start, names, offset)
+                end = Crontab.value(end, names, offset) if end else start
+                if step and not __:
+                    end = high
+            if not low <= start <= end <= high:
+                raise ValueError(f'Invalid crontab field: {field}')
+            values.update(range(start, end + 1, int(step) if step else 1))
+        return values
+
+    @staticmethod
+    def value(text, names, offset):
+        if text in names:
+            return names.index(text) + offset
+        return int(text)
+
+    def matches_day(self, time):
+        in_month = time.day in self.days_of_month
+        in_week = time.weekday() in self.days_of_week
+        # When both day fields are restricted, either may match.
+        if self.any_day_of_month:
+            return in_week
+        if self.any_day_of_week:
+            return in_month
+        return in_month or in_week
+
+    def next(self, after):
+        time = after.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = after + timedelta(days=366 * 5)
+        while time <= limit:
+            if time.month not in self.months_of_year:
+                year, month = divmod(time.month, 12)
+                time = time.replace(
+                    year=time.year + year, month=month + 1, day=1,
+                    hour=0, minute=0)
+            elif not self.matches_day(time):
+                time = time.replace(hour=0, minute=0) + timedelta(days=1)
+            elif time.hour not in self.hours:
+                time = time.replace(minute=0) + timedelta(hours=1)
+            elif time.minute not in self.minutes:
+                time += timedelta(minutes=1)
+            else:
+                return time
+        raise ValueError('Crontab expression never matches')
@@ -1,9 +1,19 @@
 import sqlalchemy
 import sqlalchemy.orm
+import sys
 
-from sqlalchemy import create_engine
+from collections import Counter, defaultdict
+from itertools import count
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine.url import make_url
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import Query, Session, SessionEvents, object_mapper
 from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy.sql import Select
+from sqlalchemy.sql.util import find_tables
+from time import perf_counter
+
+from mesh.cache import LRUCache
 
 try:
     from thread import get_ident
@@ -13,12 +23,40 @@ except ImportError:
 
 class DB:
 
+    pool_options = {
+        'pool_size': ('DB_POOL_SIZE', 'int'),
+        'max_overflow': ('DB_MAX_OVERFLOW', 'int'),
+        'pool_timeout': ('DB_POOL_TIMEOUT', 'float'),
+        'pool_recycle': ('DB_POOL_RECYCLE', 'int'),
+        'pool_pre_ping': ('DB_POOL_PRE_PING', 'bool'),
+    }
+
     @staticmethod
     def engine_options(config):
-        return {
+        options = {
             'dsn': config['DB_DSN'],
             'echo': config.bool('DB_ECHO', False),
+            'replica_dsns': [
+                dsn.strip()
+                for dsn in config.get('DB_REPLICA_DSNS', '').split(',')
+                if dsn.strip()],
+            'replica_strategy': config.get(
+                'DB_REPLICA_STRATEGY', 'round_robin'),
         }
+        # Pool options are only passed when set, because not every pool
+        # class accepts them.
+        for key, (name, kind) in DB.pool_options.items():
+            if name in config:
+                options[key] = getattr(config, kind)(name, None)
+        # The timeout is a PostgreSQL setting; other drivers reject the
+        # connect argument.
+        statement_timeout = config.int('DB_STATEMENT_TIMEOUT', 0)
+        backend = make_url(options['dsn']).get_backend_name()
+        if statement_timeout and backend == 'postgresql':
+            options['connect_args'] = {
+                'options': f'-c statement_timeout={statement_timeout}',
+            }
+        return options
 
     @staticmethod
     def session_options(config):
@@ -28,18 +66,264 @@ class DB:
         }
 
     def __init__(self, mesh):
-        self.engine = self.create_engine(self.engine_options(mesh.config))
+        self.mesh = mesh
+        self.logger = mesh.init_logger()
+        self.timing = mesh.config.bool('DB_TIMING', False)
+        self.slow_query = mesh.config.float('DB_SLOW_QUERY', 0) / 1000
+        self.repeat_threshold = mesh.config.int('DB_REPEAT_THRESHOLD', 10)
+        engine_options = self.engine_options(mesh.config)
+        self.engine = self.create_engine(engine_options)
+        self.replicas = [
+            self.create_engine(dict(engine_options, dsn=dsn))
+            for dsn in engine_options['replica_dsns']]
+        self.replica_strategy = engine_options['replica_strategy']
+        self.replica_counter = count()
+        self.query_cache = LRUCache(
+            mesh.config.int('DB_QUERY_CACHE_SIZE', 1024),
+            ttl=mesh.config.float('DB_QUERY_CACHE_TTL', 60))
         self.session = self.create_session(self.session_options(mesh.config))
         self.Model = self.create_declarative_base()
         self.include_sqlalchemy()
         mesh.teardown_context(lambda: self.session.remove())
+        if self.timing:
+            mesh.teardown_context(self.report_timing)
 
     def create_engine(self, options):
-        return create_engine(options['dsn'], echo=options['echo'])
+        kwargs = {key: options[key] for key in self.pool_options
+                  if key in options}
+        if 'connect_args' in options:
+            kwargs['connect_args'] = options['connect_args']
+        if self.timing:
+            kwargs['poolclass'] = timed_pool_class(options['dsn'])
+        engine = create_engine(options['dsn'], echo=options['echo'], **kwargs)
+        if self.timing or self.slow_query or 'TRACE_SINK' in self.mesh.config:
+            event.listen(engine, 'before_cursor_execute', self.before_cursor)
+            event.listen(engine, 'after_cursor_execute', self.after_cursor)
+        if self.timing:
+            event.listen(engine.pool, 'checkout', self.record_checkout)
+        return engine
+
+    def before_cursor(self, connection, cursor, statement, parameters,
+                      context, executemany):
+        connection.info.setdefault('mesh.started', []).append(perf_counter())
+
+    def after_cursor(self, connection, cursor, statement, parameters,
+                     context, executemany):
+        duration = perf_counter() - connection.info['mesh.started'].pop()
+        if self.slow_query and duration >= self.slow_query:
+            self.logger.warning(
+                'Slow query (%.1f ms): %s', duration * 1000, statement)
+        if self.timing:
+            stats = self.timing_stats()
+            if stats is not None:
+                stats.record(statement, duration, cursor.rowcount)
+        if self.mesh.tracer is not None:
+            self.mesh.tracer.record(
+                statement.split(None, 1)[0], 'sql', duration,
+                statement=statement)
+
+    def record_checkout(self, dbapi_connection, record, proxy):
+        waited = getattr(record, 'mesh_waited', None)
+        stats = self.timing_stats()
+        if waited is not None and stats is not None:
+            stats.checkout_wait += waited
+
+    def timing_stats(self):
+        context = self.mesh.current_context()
+        if context is None:
+            return None
+        stats = getattr(context, 'db_stats', None)
+        if stats is None:
+            stats = QueryStats()
+            setattr(context, 'db_stats', stats)
+        return stats
+
+    def report_timing(self, *args):
+        context = self.mesh.current_context()
+        stats = getattr(context, 'db_stats', None)
+        if stats is None:
+            return
+        del context.db_stats
+        name = (f"{getattr(context, 'method', '')} "
+                f"{getattr(context, 'path', '')}").strip()
+        self.logger.info(
+            '%s: %d queries in %.1f ms, %d rows, %.1f ms pool wait',
+            name, stats.count, stats.duration * 1000, stats.rows,
+            stats.checkout_wait * 1000)
+        for statement, repeats in stats.repeated(self.repeat_threshold):
+            self.logger.warning(
+                '%s: possible N+1, statement ran %d times in %.1f ms: %s',
+                name, repeats, stats.durations[statement] * 1000, statement)
 
     def create_session(self, options):
-        factory = sessionmaker(bind=self.engine, **options)
-        return scoped_session(factory, scopefunc=get_ident)
+        factory = sessionmaker(
+            bind=self.engine, class_=RoutingSession, query_cls=MeshQuery,
+            info={'db': self}, **options)
+        session = scoped_session(factory, scopefunc=self.scope)
+        if self.replicas:
+            # Once a transaction has written, reads must see the writes.
+            event.listen(session, 'after_flush', self.pin_primary)
+            event.listen(session, 'after_commit', self.unpin_primary)
+            event.listen(session, 'after_rollback', self.unpin_primary)
+        # Statement hooks need SQLAlchemy 1.4; older versions run
+        # cached queries uncached.
+        if hasattr(SessionEvents, 'do_orm_execute'):
+            event.listen(session, 'do_orm_execute', self.execute_cached)
+            event.listen(session, 'after_flush', self.record_writes)
+            event.listen(session, 'after_commit', self.invalidate_writes)
+            event.listen(session, 'after_rollback', self.forget_writes)
+        return session
+
+    def execute_cached(self, state):
+        if state.is_select:
+            options = state.execution_options
+            if options.get('mesh_cache'):
+                return self.fetch_cached(state, options.get('mesh_cache_ttl'))
+        elif state.is_insert or state.is_update or state.is_delete:
+            table = getattr(state.statement, 'table', None)
+            if table is not None:
+                state.session.info.setdefault(
+                    'mesh.written', set()).add(table.name)
+            # Core DML does not flush, so reads are pinned here.
+            if self.replicas:
+                state.session.info['mesh.primary'] = True
+
+    def fetch_cached(self, state, ttl):
+        from sqlalchemy.orm.loading import merge_frozen_result
+
+        statement = state.statement.params(state.parameters or {})
+        compiled = statement.compile()
+        params = compiled.params
+        key = ' '.join([str(compiled)] + [
+            f'{name}={params[name]!r}' for name in sorted(params)])
+
+        entry = self.query_cache.get(key)
+        if entry is None:
+            frozen = state.invoke_statement().freeze()
+            tables = {table.name for table in find_tables(
+                state.statement, include_aliases=True, include_joins=True)}
+            size = sum(sys.getsizeof(row) for row in frozen.data)
+            entry = (tables, size, frozen)
+            self.query_cache.set(key, entry, ttl)
+
+        __, __, frozen = entry
+        result = merge_frozen_result(
+            state.session, state.statement, frozen, load=False)
+        return result()
+
+    @staticmethod
+    def record_writes(session, flush_context):
+        written = session.info.setdefault('mesh.written', set())
+        for obj in (*session.new, *session.dirty, *session.deleted):
+            written.update(table.name for table in object_mapper(obj).tables)
+
+    def invalidate_writes(self, session):
+        written = session.info.pop('mesh.written', None)
+        if written:
+            self.query_cache.discard_if(
+                lambda key, entry: not entry[0].isdisjoint(written))
+
+    @staticmethod
+    def forget_writes(session):
+        session.info.pop('mesh.written', None)
+
+    def query_cache_stats(self):
+        stats = self.query_cache.stats()
+        stats['memory'] = sum(
+            size for __, size, __ in self.query_cache.values())
+        return stats
+
+    @staticmethod
+    def pin_primary(session, flush_context):
+        session.info['mesh.primary'] = True
+
+    @staticmethod
+    def unpin_primary(session):
+        session.info.pop('mesh.primary', None)
+
+    def choose_replica(self):
+        if self.replica_strategy == 'least_busy':
+            return min(self.replicas, key=self.checked_out)
+        return self.replicas[next(self.replica_counter) % len(self.replicas)]
+
+    @staticmethod
+    def checked_out(engine):
+        checkedout = getattr(engine.pool, 'checkedout', None)
+        return checkedout() if checkedout is not None else 0
+
+    def scope(self):
+        # Concurrent contexts in one thread (asyncio tasks) must not
+        # share a session.
+        return get_ident(), id(self.mesh.current_context())
+
+    def bulk_insert(self, table, rows, chunk_size=1000):
+        # Rows are inserted with one executemany per chunk, in the
+        # current session transaction.
+        table = getattr(table, '__table__', table)
+        count = 0
+        for chunk in chunks(rows, chunk_size):
+            self.session.execute(table.insert(), chunk)
+            count += len(chunk)
+        return count
+
+    def bulk_upsert(self, table, rows, index_elements=None, chunk_size=1000):
+        table = getattr(table, '__table__', table)
+        if index_elements is None:
+            index_elements = [column.name for column in table.primary_key]
+        dialect = self.session.get_bind().dialect.name
+        count = 0
+        for chunk in chunks(rows, chunk_size):
+            statement = self.upsert_statement(
+                dialect, table, chunk[0].keys(), index_elements)
+            if statement is not None:
+                self.session.execute(statement, chunk)
+            else:
+                self.upsert_rows(table, chunk, index_elements)
+            count += len(chunk)
+        return count
+
+    @staticmethod
+    def upsert_statement(dialect, table, keys, index_elements):
+        if dialect == 'postgresql':
+            from sqlalchemy.dialects.postgresql import insert
+        elif dialect == 'sqlite':
+            try:
+                from sqlalchemy.dialects.sqlite import insert
+            except ImportError:
+                return None
+        elif dialect == 'mysql':
+            from sqlalchemy.dialects.mysql import insert
+            statement = insert(table)
+            return statement.on_duplicate_key_update({
+                key: statement.inserted[key] for key in keys})
+        else:
+            return None
+        statement = insert(table)
+        update = [key for key in keys if key not in index_elements]
+        if not update:
+            return statement.on_conflict_do_nothing(
+                index_elements=index_elements)
+        return statement.on_conflict_do_update(
+            index_elements=index_elements,
+            set_={key: statement.excluded[key] for key in update})
+
+    def upsert_rows(self, table, rows, index_elements):
+        # Dialects without ON CONFLICT update first and insert missing
+        # rows.
+        for row in rows:
+            condition = sqlalchemy.and_(*[
+                table.c[key] == row[key] for key in index_elements])
+            values = {key: value for key, value in row.items()
+                      if key not in index_elements}
+            if values:
+                result = self.session.execute(
+                    table.update().where(condition).values(values))
+                if result.rowcount:
+                    continue
+            elif self.session.execute(
+                    table.select().where(condition)).first() is not None:
+                continue
+            self.session.execute(table.insert(), row)
 
     def create_declarative_base(self):
         model = declarative_base(cls=Model, name='Model')
@@ -53,6 +337,89 @@ class DB:
                     setattr(self, key, getattr(module, key))
 
 
+class RoutingSession(Session):
+
+    # Plain selects go to a replica unless the session has written in
+    # the current transaction or is flushing.
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        db = self.info.get('db')
+        if (db is not None and db.replicas
+                and isinstance(clause, Select)
+                and clause._for_update_arg is None
+                and not self._flushing
+                and not self.info.get('mesh.primary')):
+            return db.choose_replica()
+        return super().get_bind(mapper=mapper, clause=clause, **kwargs)
+
+
+class QueryStats:
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.rows = 0
+        self.checkout_wait = 0.0
+        self.statements = Counter()
+        self.durations = defaultdict(float)
+
+    def record(self, statement, duration, rows):
+        self.count += 1
+        self.duration += duration
+        if rows is not None and rows > 0:
+            self.rows += rows
+        self.statements[statement] += 1
+        self.durations[statement] += duration
+
+    def repeated(self, threshold):
+        return [(statement, repeats)
+                for statement, repeats in self.statements.most_common()
+                if repeats >= threshold]
+
+
+class TimedPool:
+
+    # Pools have no event before a checkout, so the wait is measured
+    # around getting a connection and read by the checkout listener.
+
+    def _do_get(self):
+        started = perf_counter()
+        record = super()._do_get()
+        record.mesh_waited = perf_counter() - started
+        return record
+
+
+def timed_pool_class(dsn):
+    url = make_url(dsn)
+    pool_class = url.get_dialect().get_pool_class(url)
+    return type(f'Timed{pool_class.__name__}', (TimedPool, pool_class), {})
+
+
+class MeshQuery(Query):
+
+    def cached(self, ttl=None):
+        # Results are shared between sessions until the TTL expires or
+        # a commit writes to one of the queried tables.
+        return self.execution_options(mesh_cache=True, mesh_cache_ttl=ttl)
+
+    def stream(self, chunk=1000):
+        # Rows are fetched through a server-side cursor where the
+        # driver supports one, so memory stays bounded.
+        query = self.execution_options(stream_results=True)
+        return iter(query.yield_per(chunk))
+
+
+def chunks(rows, size):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
 class Model:
 
     query = None
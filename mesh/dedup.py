@@ -0,0 +1,124 @@
+import sqlite3
+
+from mesh.cache import LRUCache
+from threading import Lock
+from time import time
+
+
+class Dedup:
+
+    # Remembers IDs of successfully processed messages, so that
+    # redeliveries can be acknowledged without running the task again.
+
+    def __init__(self, mesh):
+        config = mesh.config
+        self.ttl = config.float('AMQP_DEDUP_TTL', 3600)
+        self.cache = LRUCache(config.int('AMQP_DEDUP_SIZE', 10000), self.ttl)
+        self.hits = 0
+        self.misses = 0
+
+        backend = config.get('AMQP_DEDUP_BACKEND')
+        if backend is None:
+            self.backend = None
+        elif backend == 'db':
+            self.backend = DBBackend(mesh.init_db())
+        else:
+            self.backend = SQLiteBackend(backend)
+
+    def seen(self, message_id):
+        if message_id is None:
+            return False
+        if message_id in self.cache:
+            found = True
+        elif self.backend is not None and self.backend.seen(message_id):
+            self.cache.set(message_id, True)
+            found = True
+        else:
+            found = False
+        if found:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return found
+
+    def mark(self, message_id):
+        if message_id is None:
+            return
+        self.cache.set(message_id, True)
+        if self.backend is not None:
+            self.backend.mark(message_id, time() + self.ttl)
+
+    def stats(self):
+        return {
+            'size': len(self.cache),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+class SQLiteBackend:
+
+    purge_interval = 1000
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.lock = Lock()
+        self.marks = 0
+        with self.lock, self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS mesh_dedup '
+                '(message_id TEXT PRIMARY KEY, expires REAL NOT NULL)')
+
+    def seen(self, message_id):
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT 1 FROM mesh_dedup WHERE message_id = ? '
+                'AND expires > ?', (message_id, time())).fetchone()
+        return row is not None
+
+    def mark(self, message_id, expires):
+        with self.lock, self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO mesh_dedup VALUES (?, ?)',
+                (message_id, expires))
+            self.marks += 1
+            if self.marks % self.purge_interval == 0:
+                self.connection.execute(
+                    'DELETE FROM mesh_dedup WHERE expires <= ?', (time(),))
+
+
+class DBBackend:
+
+    purge_interval = 1000
+
+    def __init__(self, db):
+        from sqlalchemy import Column, Float, MetaData, String, Table
+
+        self.engine = db.engine
+        self.table = Table(
+            'mesh_dedup',
+            MetaData(),
+            Column('message_id', String(64), primary_key=True),
+            Column('expires', Float, nullable=False))
+        self.table.create(self.engine, checkfirst=True)
+        self.marks = 0
+
+    def seen(self, message_id):
+        table = self.table
+        query = table.select().where(
+            (table.c.message_id == message_id) & (table.c.expires > time()))
+        with self.engine.connect() as connection:
+            return connection.execute(query).first() is not None
+
+    def mark(self, message_id, expires):
+        table = self.table
+        with self.engine.begin() as connection:
+            connection.execute(
+                table.delete().where(table.c.message_id == message_id))
+            connection.execute(
+                table.insert(), {'message_id': message_id, 'expires': expires})
+        self.marks += 1
+        if self.marks % self.purge_interval == 0:
+            with self.engine.begin() as connection:
+                connection.execute(
+                    table.delete().where(table.c.expires <= time()))
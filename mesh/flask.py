@@ -1,24 +1,66 @@
 import logging
 
-from click import Command
-from flask import _app_ctx_stack
+from click import Argument, Choice, Command, Option
+from flask import appcontext_pushed, has_request_context
+from flask import request, request_started
 
 from mesh import MeshBase
 
+try:
+    from flask.globals import _cv_app
+except ImportError:
+    # Flask < 2.2 keeps contexts on a stack.
+    from flask import _app_ctx_stack
+
+    def current_app_context():
+        return _app_ctx_stack.top
+else:
+    def current_app_context():
+        return _cv_app.get(None)
+
 
 class Mesh(MeshBase):
 
+    # Non-HTTP work only needs an application context.
+    app_context_methods = ('CONSUME', 'CRON', 'RELAY')
+
     def __init__(self, app):
         super().__init__(config=None)
         app.extensions['mesh'] = self
         self.app = app
         self.logger = app.logger
 
+    def init_amqp(self):
+        if self.amqp is None:
+            if super().init_amqp() is not None:
+                self.add_worker_command()
+        return self.amqp
+
     def init_cron(self):
         if self.cron is None:
             cron = super().init_cron()
             self.app.cli.add_command(Command('cron', callback=cron.run))
-        return cron
+            self.add_worker_command()
+        return self.cron
+
+    def add_worker_command(self):
+        if 'worker' not in self.app.cli.commands:
+            self.app.cli.add_command(Command(
+                'worker',
+                callback=self.run_worker,
+                params=[
+                    Argument(
+                        ['service'],
+                        type=Choice(['amqp', 'cron']),
+                        default='amqp',
+                        required=False),
+                    Option(['-p', '--processes'], type=int),
+                    Option(['--max-messages'], type=int),
+                ]))
+
+    def run_worker(self, service, processes, max_messages):
+        from mesh.worker import run_worker
+        run_worker(self, service, processes, max_messages)
 
     def init_db(self):
         if self.db is None and 'DB_DSN' in self.config:
@@ -30,6 +72,10 @@ class Mesh(MeshBase):
                 SQLALCHEMY_DATABASE_URI=engine_options['dsn'],
                 SQLALCHEMY_ECHO=engine_options['echo'],
                 SQLALCHEMY_TRACK_MODIFICATIONS=False)
+            self.app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', {
+                key: engine_options[key]
+                for key in (*DB.pool_options, 'connect_args')
+                if key in engine_options})
 
             session_options = DB.session_options(self.config)
             self.db = SQLAlchemy(self.app, session_options=session_options)
@@ -39,6 +85,28 @@ class Mesh(MeshBase):
     def init_logger(self):
         return self.logger
 
+    def init_metrics(self):
+        if self.metrics is None:
+            from flask import Response
+            from mesh.metrics import Registry
+
+            metrics = self.metrics = Registry()
+            self.app.add_url_rule(
+                '/metrics', 'metrics',
+                lambda: Response(
+                    metrics.render(), content_type=metrics.content_type))
+        return self.metrics
+
+    def init_profiler(self):
+        if self.profiler is None:
+            from flask import Response
+
+            profiler = super().init_profiler()
+            self.app.add_url_rule(
+                '/debug/profiles', 'profiles',
+                lambda: Response(profiler.render(), content_type='text/plain'))
+        return self.profiler
+
     def init_sentry(self):
         if self.sentry is None and not self.app.debug:
             client = super().init_sentry()
@@ -51,11 +119,33 @@ class Mesh(MeshBase):
                     level=logging.WARNING)
         return self.sentry
 
+    def setup_context(self, callback):
+        # Requests push their application context before the request
+        # is available, so they are set up when the request starts.
+        def app_context_pushed(sender, **kwargs):
+            if getattr(current_app_context(), 'method', None) is not None:
+                callback()
+
+        appcontext_pushed.connect(app_context_pushed, self.app, weak=False)
+        request_started.connect(
+            lambda sender, **kwargs: callback(), self.app, weak=False)
+
     def teardown_context(self, callback):
         self.app.teardown_appcontext(callback)
 
+    def describe_context(self, context):
+        method, path, headers = super().describe_context(context)
+        if method is None and has_request_context():
+            return request.method, request.path, request.headers
+        return method, path, headers
+
     def make_context(self, **kwargs):
+        if kwargs.get('method') in self.app_context_methods:
+            context = self.app.app_context()
+            for key, value in kwargs.items():
+                setattr(context, key, value)
+            return context
         return self.app.test_request_context(**kwargs)
 
     def current_context(self):
-        return _app_ctx_stack.top
+        return current_app_context()
@@ -1,10 +1,22 @@
 import json
 
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from functools import wraps
 from requests import Session
 from requests.adapters import HTTPAdapter
 from requests.auth import _basic_auth_str
+from requests.exceptions import Timeout
 from requests.utils import select_proxy
+from urllib.parse import urlparse
+from time import monotonic
+from urllib3.util.retry import Retry
+
+try:
+    from contextvars import copy_context
+except ImportError:
+    copy_context = None
+
+from mesh import metrics, trace
 
 try:
     from flask import abort, jsonify, request
@@ -23,7 +35,7 @@ class HTTP:
         self.proxies = {}
         self.servers = {}
         self.clients = set()
-        self.adapter = Adapter(self.servers)
+        self.executor = None
 
         path_or_config = mesh.config.get('HTTP_CONFIG')
         if path_or_config is None:
@@ -50,20 +62,131 @@ class HTTP:
                 username, password = auth.split(':')
                 self.clients.add((username, password))
 
+        # Adapters are shared by all sessions, so they hold the
+        # connection pools. Hosts may override the defaults.
+        self.adapter = self.make_adapter(config)
+        self.adapters = {
+            prefix: self.make_adapter(dict(config, **options))
+            for prefix, options in config.get('hosts', {}).items()}
+        self.workers = config.get('workers', 32)
+
+    def make_adapter(self, config):
+        pool = config.get('pool', {})
+        timeout = config.get('timeout', {})
+        return Adapter(
+            self.servers,
+            self.mesh,
+            pool_connections=pool.get('connections', 10),
+            pool_maxsize=pool.get('maxsize', 10),
+            pool_block=pool.get('block', False),
+            max_retries=self.make_retry(config.get('retries', {})),
+            timeout=(timeout.get('connect', 5), timeout.get('read', 20)))
+
+    @staticmethod
+    def make_retry(options):
+        # Only idempotent methods are retried unless configured
+        # otherwise.
+        methods = options.get('methods', Retry.DEFAULT_ALLOWED_METHODS)
+        total = options.get('total', 0)
+        # Without read retries, read errors are raised as they are, as
+        # requests does by default, so a read timeout stays a Timeout.
+        return Retry(
+            total=total,
+            connect=options.get('connect'),
+            read=options.get('read', None if total else False),
+            backoff_factor=options.get('backoff_factor', 0),
+            status_forcelist=options.get('status_forcelist'),
+            allowed_methods=frozenset(method.upper() for method in methods),
+            raise_on_status=False)
+
     @property
     def session(self):
         context = self.mesh.current_context()
         session = getattr(context, 'http_session', None)
         if session is None:
-            # TODO: Add retry settings.
-            session = Session()
-            session.mount('http://', self.adapter)
-            session.mount('https://', self.adapter)
-            session.proxies = self.proxies
-            session.timeout = 20
+            session = self.make_session()
             setattr(context, 'http_session', session)
         return session
 
+    def make_session(self):
+        session = Session()
+        session.mount('http://', self.adapter)
+        session.mount('https://', self.adapter)
+        for prefix, adapter in self.adapters.items():
+            session.mount(prefix, adapter)
+        session.proxies = self.proxies
+        return session
+
+    def gather(self, requests, concurrency=10, deadline=None):
+        # Runs requests in parallel and returns responses in order.
+        # Failed requests give their exception instead; requests still
+        # pending at the deadline give a Timeout.
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(
+                self.workers, thread_name_prefix='http')
+        expires = monotonic() + deadline if deadline is not None else None
+        results = [None] * len(requests)
+        waiting = list(enumerate(requests))
+        waiting.reverse()
+        running = {}
+
+        while waiting or running:
+            while waiting and len(running) < concurrency:
+                index, kwargs = waiting.pop()
+                running[self.submit(kwargs, expires)] = index
+            timeout = None
+            if expires is not None:
+                timeout = expires - monotonic()
+                if timeout <= 0:
+                    break
+            done, __ = wait(running, timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                index = running.pop(future)
+                exception = future.exception()
+                results[index] = (
+                    exception if exception is not None else future.result())
+
+        for future, index in running.items():
+            future.cancel()
+            results[index] = Timeout('Deadline exceeded')
+        for index, __ in waiting:
+            results[index] = Timeout('Deadline exceeded')
+        return results
+
+    def submit(self, kwargs, expires):
+        kwargs = dict(kwargs)
+        method = kwargs.pop('method', 'GET')
+        url = kwargs.pop('url')
+        tracer = self.mesh.tracer
+        parent = tracer.current_span() if tracer is not None else None
+
+        def send():
+            if tracer is not None:
+                tracer.fork(parent)
+            with self.make_session() as session:
+                # Requests in flight cannot be interrupted, so their
+                # timeout must not outlast the deadline.
+                if expires is not None:
+                    timeout = kwargs.get('timeout')
+                    if timeout is None:
+                        timeout = session.get_adapter(url).timeout
+                    kwargs['timeout'] = cap_timeout(
+                        timeout, max(expires - monotonic(), 0.001))
+                return session.request(method, url, **kwargs)
+
+        if copy_context is not None:
+            return self.executor.submit(copy_context().run, send)
+        return self.executor.submit(send)
+
+    def after_fork(self):
+        self.executor = None
+
+    def stats(self):
+        stats = {'default': self.adapter.stats()}
+        for prefix, adapter in self.adapters.items():
+            stats[prefix] = adapter.stats()
+        return stats
+
     def auth_required(self, callback):
         @wraps(callback)
         def wrapper(**values):
@@ -78,19 +201,36 @@ class HTTP:
     def json_endpoint(self, callback):
         @wraps(callback)
         def wrapper(**values):
-            try:
-                return callback(**values)
-            except HTTPException as exc:
-                response = jsonify(message=HTTP_STATUS_CODES[exc.code])
-                response.status_code = exc.code
-                return response
-            except Exception:
-                self.logger.exception('Internal server error')
-                response = jsonify(message='Internal server error')
-                response.status_code = 500
-                return response
+            timer = metrics.timer(
+                self.mesh, 'mesh_http_request_seconds',
+                'JSON endpoint latency',
+                endpoint=callback.__name__, status=200)
+            with timer:
+                response = self.call_endpoint(callback, values)
+                # Views may return (body, status), (body, headers) or
+                # (body, status, headers).
+                if isinstance(response, tuple) and len(response) > 1 \
+                        and isinstance(response[1], int):
+                    timer.labels['status'] = response[1]
+                elif not isinstance(response, tuple):
+                    timer.labels['status'] = getattr(
+                        response, 'status_code', 200)
+            return response
         return wrapper
 
+    def call_endpoint(self, callback, values):
+        try:
+            return callback(**values)
+        except HTTPException as exc:
+            response = jsonify(message=HTTP_STATUS_CODES[exc.code])
+            response.status_code = exc.code
+            return response
+        except Exception:
+            self.logger.exception('Internal server error')
+            response = jsonify(message='Internal server error')
+            response.status_code = 500
+            return response
+
     def link_header(self, *items):
         links = []
         for item in items:
@@ -103,11 +243,30 @@ class HTTP:
         return ', '.join(links)
 
 
+def cap_timeout(timeout, limit):
+    if timeout is None:
+        return limit
+    if isinstance(timeout, tuple):
+        return tuple(cap_timeout(value, limit) for value in timeout)
+    return min(timeout, limit)
+
+
 class Adapter(HTTPAdapter):
 
-    def __init__(self, servers):
-        super().__init__()
+    def __init__(self, servers, mesh=None, timeout=None, **kwargs):
+        super().__init__(**kwargs)
         self.servers = servers
+        self.mesh = mesh
+        self.timeout = timeout
+
+    def send(self, request, **kwargs):
+        # Requests without an explicit timeout would wait forever.
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        host = urlparse(request.url).netloc
+        name = f'{request.method} {host}'
+        with trace.span(self.mesh, name, 'http', url=request.url):
+            return super().send(request, **kwargs)
 
     def add_headers(self, request, **kwargs):
         auth = select_proxy(request.url, self.servers)
@@ -115,3 +274,25 @@ class Adapter(HTTPAdapter):
             username, password = auth
             value = _basic_auth_str(username, password)
             request.headers.setdefault('Authorization', value)
+        tracer = getattr(self.mesh, 'tracer', None)
+        if tracer is not None:
+            tracer.inject(request.headers)
+
+    def stats(self):
+        pools = {}
+        managers = [self.poolmanager, *self.proxy_manager.values()]
+        for manager in managers:
+            for key in list(manager.pools.keys()):
+                pool = manager.pools.get(key)
+                if pool is None:
+                    continue
+                # Free slots in the queue are None until a connection
+                # is returned.
+                queue = list(pool.pool.queue) if pool.pool is not None else []
+                pools[f'{pool.scheme}://{pool.host}:{pool.port}'] = {
+                    'connections': pool.num_connections,
+                    'requests': pool.num_requests,
+                    'idle': sum(1 for conn in queue if conn is not None),
+                    'maxsize': pool.pool.maxsize if pool.pool else 0,
+                }
+        return pools
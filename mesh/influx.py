@@ -1,10 +1,118 @@
+import atexit
+
+from datetime import datetime
 from influxdb import InfluxDBClient
+from queue import Empty, Full, Queue
+from threading import Lock, Thread
+from time import monotonic, sleep
 
 
 class Influx:
 
+    # Points are queued and written in batches by a background thread,
+    # so handlers do not wait for InfluxDB.
+
     def __init__(self, mesh):
-        self.dsn = mesh.config['INFLUX_DSN']
+        config = mesh.config
+        self.dsn = config['INFLUX_DSN']
+        self.logger = mesh.init_logger()
+        self.batch_size = config.int('INFLUX_BATCH_SIZE', 500)
+        self.flush_interval = config.float('INFLUX_FLUSH_INTERVAL', 1)
+        self.queue_size = config.int('INFLUX_QUEUE_SIZE', 10000)
+        self.overflow = config.get('INFLUX_OVERFLOW', 'drop')
+        self.retries = config.int('INFLUX_RETRIES', 3)
+        self.retry_backoff = config.float('INFLUX_RETRY_BACKOFF', 0.5)
+        assert self.overflow in ('drop', 'block')
+
+        self.shared_client = None
+        self.queue = Queue(self.queue_size)
+        self.thread = None
+        self.mutex = Lock()
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        atexit.register(self.close)
 
     def client(self):
-        return InfluxDBClient.from_dsn(self.dsn)
+        if self.shared_client is None:
+            self.shared_client = InfluxDBClient.from_dsn(self.dsn)
+        return self.shared_client
+
+    def write(self, measurement, tags=None, fields=None, time=None):
+        point = {
+            'measurement': measurement,
+            'tags': tags or {},
+            'fields': fields or {},
+            'time': time or datetime.utcnow(),
+        }
+        self.start()
+        if self.overflow == 'block':
+            self.queue.put(point)
+            return True
+        try:
+            self.queue.put_nowait(point)
+        except Full:
+            self.dropped += 1
+            return False
+        return True
+
+    def start(self):
+        if self.thread is None:
+            with self.mutex:
+                if self.thread is None:
+                    self.thread = Thread(
+                        target=self.run, name='influx-writer', daemon=True)
+                    self.thread.start()
+
+    def close(self, timeout=10):
+        with self.mutex:
+            thread, self.thread = self.thread, None
+        if thread is not None and thread.is_alive():
+            self.queue.put(None)
+            thread.join(timeout)
+
+    def after_fork(self):
+        self.shared_client = None
+        self.queue = Queue(self.queue_size)
+        self.thread = None
+
+    def run(self):
+        running = True
+        while running:
+            batch = []
+            deadline = monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    point = self.queue.get(
+                        timeout=max(deadline - monotonic(), 0))
+                except Empty:
+                    break
+                if point is None:
+                    running = False
+                    break
+                batch.append(point)
+            if batch:
+                self.flush(batch)
+
+    def flush(self, batch):
+        for attempt in range(self.retries + 1):
+            try:
+                self.client().write_points(batch)
+            except Exception:
+                if attempt == self.retries:
+                    self.logger.exception(
+                        'Failed to write %d Influx points', len(batch))
+                    self.failed += len(batch)
+                    return
+                sleep(self.retry_backoff * 2 ** attempt)
+            else:
+                self.written += len(batch)
+                return
+
+    def stats(self):
+        return {
+            'queued': self.queue.qsize(),
+            'written': self.written,
+            'dropped': self.dropped,
+            'failed': self.failed,
+        }
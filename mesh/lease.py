@@ -0,0 +1,54 @@
+import os
+import socket
+
+from datetime import datetime, timedelta
+from sqlalchemy import Column, DateTime, MetaData, String, Table
+from sqlalchemy.exc import IntegrityError
+from time import monotonic
+
+
+class Lease:
+
+    # A lease is a row keyed on the job name and fire time. The replica
+    # whose insert succeeds runs the firing; replicas with busy workers
+    # get there later and lose, which spreads the jobs.
+
+    def __init__(self, mesh, db):
+        config = mesh.config
+        self.db = db
+        self.owner = f'{socket.gethostname()}:{os.getpid()}'
+        self.ttl = timedelta(seconds=config.float('CRON_LEASE_TTL', 86400))
+        self.purge_interval = 3600
+        self.purged = None
+
+        self.table = Table(
+            config.get('CRON_LEASE_TABLE', 'mesh_cron_lease'),
+            MetaData(),
+            Column('name', String(255), primary_key=True),
+            Column('fire_time', DateTime, primary_key=True),
+            Column('owner', String(255), nullable=False),
+            Column('acquired_at', DateTime, nullable=False))
+        self.table.create(db.engine, checkfirst=True)
+
+    def acquire(self, name, fire_time):
+        now = datetime.utcnow()
+        try:
+            with self.db.engine.begin() as connection:
+                connection.execute(self.table.insert(), {
+                    'name': name,
+                    'fire_time': fire_time,
+                    'owner': self.owner,
+                    'acquired_at': now,
+                })
+        except IntegrityError:
+            return False
+        if (self.purged is None or
+                monotonic() - self.purged > self.purge_interval):
+            self.purge(now)
+        return True
+
+    def purge(self, now):
+        self.purged = monotonic()
+        with self.db.engine.begin() as connection:
+            connection.execute(self.table.delete().where(
+                self.table.c.acquired_at < now - self.ttl))
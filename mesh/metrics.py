@@ -0,0 +1,264 @@
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from threading import Lock, Thread, current_thread, local
+from time import perf_counter
+
+
+class Registry:
+
+    content_type = 'text/plain; version=0.0.4; charset=utf-8'
+
+    def __init__(self):
+        self.metrics = {}
+        self.mutex = Lock()
+        self.server = None
+        self.address = None
+
+    def counter(self, name, help='', labels=()):
+        return self.register(Counter, name, help, labels)
+
+    def gauge(self, name, help='', labels=()):
+        return self.register(Gauge, name, help, labels)
+
+    def histogram(self, name, help='', labels=(), buckets=None):
+        return self.register(Histogram, name, help, labels, buckets)
+
+    def register(self, cls, name, *args):
+        metric = self.metrics.get(name)
+        if metric is None:
+            with self.mutex:
+                metric = self.metrics.get(name)
+                if metric is None:
+                    metric = self.metrics[name] = cls(name, *args)
+        assert isinstance(metric, cls)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines.extend(metric.render())
+        lines.append('')
+        return '\n'.join(lines)
+
+    def serve(self, port, host=''):
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', registry.content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = MetricsServer((host, port), Handler)
+        self.address = (host, port)
+        thread = Thread(
+            target=self.server.serve_forever, name='metrics', daemon=True)
+        thread.start()
+        return self.server
+
+    def after_fork(self, worker=0):
+        # The server thread stays in the parent process, which does no
+        # work. Each worker serves its own metrics on the following
+        # ports instead.
+        if self.server is not None:
+            self.server.server_close()
+            host, port = self.address
+            self.serve(port + worker + 1, host)
+
+    def close(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+class MetricsServer(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+
+
+class Metric:
+
+    # Each thread updates its own shard without locking; shards are
+    # merged when the metrics are rendered. Shards of finished threads
+    # are folded into a base total, so they do not pile up.
+
+    type = None
+
+    def __init__(self, name, help, labels):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.shards = []
+        self.base = {}
+        self.local = local()
+        self.mutex = Lock()
+
+    def shard(self):
+        try:
+            return self.local.values
+        except AttributeError:
+            values = self.local.values = {}
+            with self.mutex:
+                self.shards.append((current_thread(), values))
+            return values
+
+    def collect(self):
+        with self.mutex:
+            shards = []
+            for thread, values in self.shards:
+                if thread.is_alive():
+                    shards.append((thread, values))
+                else:
+                    self.merge(self.base, values)
+            self.shards = shards
+            return [dict(self.base)] + [dict(values) for __, values in shards]
+
+    def format_labels(self, values, extra=()):
+        pairs = list(zip(self.label_names, values)) + list(extra)
+        if not pairs:
+            return ''
+        text = ','.join(f'{name}="{escape(value)}"' for name, value in pairs)
+        return '{' + text + '}'
+
+    def header(self):
+        return [f'# HELP {self.name} {self.help}',
+                f'# TYPE {self.name} {self.type}']
+
+
+class Counter(Metric):
+
+    type = 'counter'
+
+    def inc(self, *labels, amount=1):
+        shard = self.shard()
+        shard[labels] = shard.get(labels, 0) + amount
+
+    def value(self, *labels):
+        return sum(shard.get(labels, 0) for shard in self.collect())
+
+    @staticmethod
+    def merge(totals, shard):
+        for labels, value in shard.items():
+            totals[labels] = totals.get(labels, 0) + value
+
+    def render(self):
+        totals = {}
+        for shard in self.collect():
+            self.merge(totals, shard)
+        lines = self.header()
+        for labels, value in totals.items():
+            lines.append(f'{self.name}{self.format_labels(labels)} {value}')
+        return lines
+
+
+class Gauge(Metric):
+
+    # Gauges hold one value per label set, so they are not sharded.
+
+    type = 'gauge'
+
+    def __init__(self, name, help, labels):
+        super().__init__(name, help, labels)
+        self.values = {}
+
+    def set(self, value, *labels):
+        self.values[labels] = value
+
+    def value(self, *labels):
+        return self.values.get(labels, 0)
+
+    def render(self):
+        lines = self.header()
+        for labels, value in list(self.values.items()):
+            lines.append(f'{self.name}{self.format_labels(labels)} {value}')
+        return lines
+
+
+class Histogram(Metric):
+
+    type = 'histogram'
+
+    default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5,
+                       10)
+
+    def __init__(self, name, help, labels, buckets=None):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets or self.default_buckets)
+
+    def observe(self, value, *labels):
+        shard = self.shard()
+        entry = shard.get(labels)
+        if entry is None:
+            # Counts per bucket, the +Inf bucket and the sum.
+            entry = shard[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        entry[bisect_left(self.buckets, value)] += 1
+        entry[-1] += value
+
+    @staticmethod
+    def merge(totals, shard):
+        for labels, entry in shard.items():
+            total = totals.get(labels)
+            if total is None:
+                totals[labels] = list(entry)
+            else:
+                for index, value in enumerate(entry):
+                    total[index] += value
+
+    def render(self):
+        totals = {}
+        for shard in self.collect():
+            self.merge(totals, shard)
+        lines = self.header()
+        bounds = [str(bound) for bound in self.buckets] + ['+Inf']
+        for labels, entry in totals.items():
+            cumulative = 0
+            for bound, count in zip(bounds, entry):
+                cumulative += count
+                label_text = self.format_labels(labels, [('le', bound)])
+                lines.append(f'{self.name}_bucket{label_text} {cumulative}')
+            label_text = self.format_labels(labels)
+            lines.append(f'{self.name}_sum{label_text} {entry[-1]}')
+            lines.append(f'{self.name}_count{label_text} {cumulative}')
+        return lines
+
+
+class Timer:
+
+    # Labels may be changed inside the block, e.g. to add a status.
+
+    def __init__(self, registry, name, help, labels):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.started = None
+
+    def __enter__(self):
+        if self.registry is not None:
+            self.started = perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.registry is not None:
+            histogram = self.registry.histogram(
+                self.name, self.help, tuple(self.labels))
+            histogram.observe(
+                perf_counter() - self.started, *self.labels.values())
+
+
+def timer(mesh, name, help='', **labels):
+    return Timer(getattr(mesh, 'metrics', None), name, help, labels)
+
+
+def escape(value):
+    return (str(value).replace('\\', r'\\').replace('"', r'\"')
+            .replace('\n', r'\n'))
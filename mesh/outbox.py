@@ -0,0 +1,152 @@
+from datetime import datetime
+from sqlalchemy import Column, DateTime, Integer, MetaData, PickleType, Table
+from sqlalchemy import event
+from threading import Event, Lock, Thread
+
+from mesh.amqp import PublishError, Session
+
+
+class Outbox:
+
+    # Messages are stored in the DB transaction which commits the AMQP
+    # session and published later by a relay thread.
+
+    max_backoff = 60
+
+    def __init__(self, amqp, db):
+        config = amqp.mesh.config
+        self.amqp = amqp
+        self.db = db
+        self.logger = amqp.logger
+        self.batch_size = config.int('AMQP_OUTBOX_BATCH_SIZE', 100)
+        self.interval = config.float('AMQP_OUTBOX_INTERVAL', 1)
+
+        self.table = Table(
+            config.get('AMQP_OUTBOX_TABLE', 'mesh_outbox'),
+            MetaData(),
+            Column('id', Integer, primary_key=True),
+            Column('created_at', DateTime, nullable=False,
+                   default=datetime.utcnow),
+            Column('message', PickleType, nullable=False))
+        self.table.create(db.engine, checkfirst=True)
+
+        self.session = None
+        self.thread = None
+        self.running = False
+        self.wakeup = Event()
+        self.mutex = Lock()
+
+        event.listen(db.session, 'before_commit', self.before_commit)
+        event.listen(db.session, 'after_commit', self.after_commit)
+
+    def commit(self):
+        self.db.session.commit()
+
+    def before_commit(self, db_session):
+        context = self.amqp.mesh.current_context()
+        session = getattr(context, 'amqp_session', None)
+        if session is None:
+            return
+        if session.new:
+            session.flush()
+        if session.pending:
+            for message in session.pending:
+                if message['reply_to'] == Session.reply_queue.name:
+                    raise ValueError(
+                        'Requests with direct replies cannot be relayed')
+            db_session.execute(
+                self.table.insert(),
+                [{'message': message} for message in session.pending])
+            session.pending.clear()
+            db_session.info['mesh.outbox'] = True
+
+    def after_commit(self, db_session):
+        if db_session.info.pop('mesh.outbox', False):
+            self.start()
+            self.wakeup.set()
+
+    def start(self):
+        with self.mutex:
+            if self.thread is None or not self.thread.is_alive():
+                self.running = True
+                self.thread = Thread(
+                    target=self.run, name='amqp-outbox', daemon=True)
+                self.thread.start()
+
+    def close(self):
+        self.running = False
+        self.wakeup.set()
+        if self.thread is not None:
+            self.thread.join(self.interval + 1)
+            self.thread = None
+        if self.session is not None:
+            self.session.close()
+            self.session = None
+
+    def after_fork(self):
+        self.session = None
+        self.thread = None
+
+    def run(self):
+        # Mesh contexts log and swallow errors, but Flask contexts let
+        # them propagate, so either way a failed relay leaves no count
+        # and the relay backs off.
+        failures = 0
+        while self.running:
+            count = None
+            try:
+                with self.amqp.mesh.make_context(
+                        method='RELAY', path='/outbox'):
+                    count = self.relay()
+            except Exception:
+                self.logger.exception('Outbox relay failed')
+            failures = failures + 1 if count is None else 0
+            if failures:
+                delay = min(self.interval * 2 ** failures, self.max_backoff)
+            elif count < self.batch_size:
+                delay = self.interval
+            else:
+                continue
+            self.wakeup.wait(delay)
+            self.wakeup.clear()
+
+    def relay(self):
+        db_session = self.db.session
+        table = self.table
+        rows = db_session.execute(
+            table.select()
+            .order_by(table.c.id)
+            .limit(self.batch_size)
+            .with_for_update(skip_locked=True)).fetchall()
+        if not rows:
+            db_session.rollback()
+            return 0
+
+        session = self.init_session()
+        messages = [row.message for row in rows]
+        try:
+            session.publish_confirmed(messages)
+        except PublishError as exc:
+            self.logger.warning('Outbox relay failed: %s', exc)
+            failed = {id(message) for message in exc.messages}
+        else:
+            failed = set()
+        finally:
+            session.rollback()
+
+        published = [row.id for row, message in zip(rows, messages)
+                     if id(message) not in failed]
+        if published:
+            db_session.execute(
+                table.delete().where(table.c.id.in_(published)))
+        db_session.commit()
+        return len(published)
+
+    def init_session(self):
+        if self.session is not None and not self.session.connected:
+            self.session.close()
+            self.session = None
+        if self.session is None:
+            link = self.amqp.pool.choose_link()
+            self.session = Session(self.amqp, link, confirm=True)
+        return self.session
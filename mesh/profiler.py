@@ -0,0 +1,183 @@
+import atexit
+import cProfile
+import heapq
+import io
+import os
+import pstats
+import re
+import sys
+
+from collections import Counter, defaultdict
+from itertools import count
+from threading import Lock, Thread, get_ident
+from time import perf_counter, sleep
+
+
+class Profiler:
+
+    # Every Nth context runs under cProfile. Other contexts are only
+    # watched by a sampling thread, which records their stacks once
+    # they run longer than the threshold, so fast contexts cost almost
+    # nothing. The slowest profiles per method and path are kept.
+
+    def __init__(self, mesh):
+        config = mesh.config
+        self.mesh = mesh
+        self.every = config.int('PROFILE_EVERY', 0)
+        self.threshold = config.float('PROFILE_THRESHOLD', 0) / 1000
+        self.interval = config.float('PROFILE_INTERVAL', 10) / 1000
+        self.top = config.int('PROFILE_TOP', 5)
+        self.directory = config.get('PROFILE_DIR')
+        self.counter = count(1)
+        self.sequence = count()
+        self.active = set()
+        self.slowest = defaultdict(list)
+        self.mutex = Lock()
+        self.thread = None
+
+        mesh.setup_context(self.begin_context)
+        mesh.teardown_context(self.end_context)
+        atexit.register(self.close)
+
+    def begin_context(self, *args):
+        context = self.mesh.current_context()
+        if context is None:
+            return
+        record = getattr(context, 'profile_record', None)
+        if record is not None:
+            record.depth += 1
+            return
+        record = context.profile_record = ProfileRecord()
+        if self.every and next(self.counter) % self.every == 0:
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError:
+                # Another profiler is active in this process.
+                pass
+            else:
+                record.profile = profile
+                return
+        if self.threshold:
+            self.active.add(record)
+            self.start()
+
+    def end_context(self, *args):
+        context = self.mesh.current_context()
+        record = getattr(context, 'profile_record', None)
+        if record is None:
+            return
+        record.depth -= 1
+        if record.depth:
+            return
+        del context.profile_record
+        self.active.discard(record)
+        duration = perf_counter() - record.started
+
+        if record.profile is not None:
+            record.profile.disable()
+            text = format_profile(record.profile)
+        elif record.samples and duration >= self.threshold:
+            text = format_samples(record.samples)
+        else:
+            return
+        method, path, __ = self.mesh.describe_context(context)
+        self.keep(f'{method} {path}', duration, text)
+
+    def keep(self, name, duration, text):
+        with self.mutex:
+            profiles = self.slowest[name]
+            entry = (duration, next(self.sequence), text)
+            if len(profiles) < self.top:
+                heapq.heappush(profiles, entry)
+            else:
+                heapq.heappushpop(profiles, entry)
+
+    def start(self):
+        if self.thread is None:
+            with self.mutex:
+                if self.thread is None:
+                    self.thread = Thread(
+                        target=self.sample, name='profiler', daemon=True)
+                    self.thread.start()
+
+    def sample(self):
+        while True:
+            sleep(self.interval)
+            if not self.active:
+                continue
+            frames = sys._current_frames()
+            now = perf_counter()
+            # Nested contexts and asyncio tasks share a thread, so each
+            # of their records gets the thread's stack.
+            for record in list(self.active):
+                frame = frames.get(record.thread)
+                if frame is None or now - record.started < self.threshold:
+                    continue
+                record.samples[stack(frame)] += 1
+
+    def after_fork(self):
+        self.thread = None
+        self.active.clear()
+
+    def profiles(self):
+        with self.mutex:
+            return {name: sorted(profiles, reverse=True)
+                    for name, profiles in self.slowest.items()}
+
+    def render(self):
+        output = []
+        for name, profiles in sorted(self.profiles().items()):
+            for duration, __, text in profiles:
+                output.append(f'=== {name} ({duration * 1000:.1f} ms)\n')
+                output.append(text)
+                output.append('\n')
+        return ''.join(output)
+
+    def close(self):
+        if self.directory is not None:
+            self.dump(self.directory)
+
+    def dump(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        for name, profiles in self.profiles().items():
+            slug = re.sub(r'[^\w.-]+', '_', name).strip('_')
+            for rank, (duration, __, text) in enumerate(profiles, 1):
+                path = os.path.join(directory, f'{slug}-{rank}.txt')
+                with open(path, 'w') as fp:
+                    fp.write(f'{name} ({duration * 1000:.1f} ms)\n\n')
+                    fp.write(text)
+
+
+class ProfileRecord:
+
+    def __init__(self):
+        self.thread = get_ident()
+        self.started = perf_counter()
+        self.depth = 1
+        self.profile = None
+        self.samples = Counter()
+
+
+def stack(frame):
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(
+            f'{code.co_name} ({os.path.basename(code.co_filename)}:'
+            f'{frame.f_lineno})')
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+def format_profile(profile, limit=40):
+    output = io.StringIO()
+    stats = pstats.Stats(profile, stream=output)
+    stats.sort_stats('cumulative').print_stats(limit)
+    return output.getvalue()
+
+
+def format_samples(samples):
+    # Collapsed stacks, as read by flame graph tools.
+    return ''.join(f'{stack} {count}\n'
+                   for stack, count in samples.most_common())
@@ -0,0 +1,274 @@
+import atexit
+import json
+import random
+
+from threading import Event, Lock, Thread
+from time import perf_counter, time
+
+from mesh import make_context_var
+
+
+class Span:
+
+    __slots__ = ('trace_id', 'span_id', 'parent_id', 'name', 'kind', 'tags',
+                 'timestamp', 'started', 'duration')
+
+    def __init__(self, trace_id, parent_id, name, kind, tags=None):
+        self.trace_id = trace_id
+        self.span_id = f'{random.getrandbits(64):016x}'
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = kind
+        self.tags = tags or {}
+        self.timestamp = time()
+        self.started = perf_counter()
+        self.duration = None
+
+    @property
+    def traceparent(self):
+        return f'00-{self.trace_id}-{self.span_id}-01'
+
+    def finish(self, duration=None):
+        if duration is None:
+            duration = perf_counter() - self.started
+        self.duration = duration
+
+    def as_dict(self):
+        return {
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'kind': self.kind,
+            'timestamp': self.timestamp,
+            'duration': self.duration,
+            'tags': self.tags,
+        }
+
+
+class Tracer:
+
+    # Every context gets a root span; publishes, requests, outbound
+    # HTTP calls and SQL statements are its children. Finished spans
+    # are exported in batches by a background thread. Open spans are
+    # kept in a context variable, so that a nested context becomes a
+    # child of the outer one.
+
+    header = 'traceparent'
+
+    def __init__(self, mesh, sink=None):
+        config = mesh.config
+        self.mesh = mesh
+        self.logger = mesh.init_logger()
+        self.sink = sink if sink is not None else self.make_sink(mesh)
+        self.batch_size = config.int('TRACE_BATCH_SIZE', 1000)
+        self.flush_interval = config.float('TRACE_FLUSH_INTERVAL', 5)
+        self.finished = []
+        self.mutex = Lock()
+        self.wakeup = Event()
+        self.thread = None
+        self.running = False
+        self.stack = make_context_var('mesh.trace')
+
+        mesh.setup_context(self.begin_context)
+        mesh.teardown_context(self.end_context)
+        atexit.register(self.close)
+
+    @staticmethod
+    def make_sink(mesh):
+        target = mesh.config['TRACE_SINK']
+        if target == 'influx':
+            return InfluxSink(mesh.init_influx())
+        return JSONLSink(target)
+
+    def begin_context(self, *args):
+        context = self.mesh.current_context()
+        if context is None:
+            return
+        spans = getattr(context, 'trace_spans', None)
+        if spans:
+            context.trace_depth += 1
+            return
+        method, path, headers = self.mesh.describe_context(context)
+        trace_id, parent_id = self.extract(headers)
+        outer = self.current_span()
+        if parent_id is None and outer is not None:
+            trace_id, parent_id = outer.trace_id, outer.span_id
+        span = Span(trace_id, parent_id, f'{method} {path}', 'context')
+        context.trace_spans = [span]
+        context.trace_depth = 1
+        context.trace_token = self.stack.set(context.trace_spans)
+
+    def end_context(self, *args):
+        context = self.mesh.current_context()
+        spans = getattr(context, 'trace_spans', None)
+        if not spans:
+            return
+        context.trace_depth -= 1
+        if context.trace_depth == 0:
+            span = spans[0]
+            self.stack.reset(context.trace_token)
+            del context.trace_spans, context.trace_token
+            span.finish()
+            self.export(span)
+
+    def current_span(self):
+        spans = self.stack.get()
+        return spans[-1] if spans else None
+
+    def fork(self, parent):
+        # Work submitted to another thread gets its own span stack
+        # under the span that was current when it was submitted.
+        self.stack.set([parent] if parent is not None else None)
+
+    def span(self, name, kind, **tags):
+        return SpanScope(self, name, kind, tags)
+
+    def record(self, name, kind, duration, **tags):
+        # Records a child span that has already finished.
+        parent = self.current_span()
+        if parent is None:
+            return
+        span = Span(parent.trace_id, parent.span_id, name, kind, tags)
+        span.started -= duration
+        span.timestamp -= duration
+        span.finish(duration)
+        self.export(span)
+
+    def inject(self, headers):
+        span = self.current_span()
+        if span is not None:
+            headers[self.header] = span.traceparent
+        return headers
+
+    def extract(self, headers):
+        value = headers.get(self.header) if headers else None
+        if value:
+            parts = value.split('-')
+            if len(parts) == 4 and len(parts[1]) == 32:
+                return parts[1], parts[2]
+        return f'{random.getrandbits(128):032x}', None
+
+    def export(self, span):
+        with self.mutex:
+            self.finished.append(span)
+            full = len(self.finished) >= self.batch_size
+        self.start()
+        if full:
+            self.wakeup.set()
+
+    def start(self):
+        if self.thread is None:
+            with self.mutex:
+                if self.thread is None:
+                    self.running = True
+                    self.thread = Thread(
+                        target=self.run, name='trace-export', daemon=True)
+                    self.thread.start()
+
+    def close(self):
+        self.running = False
+        self.wakeup.set()
+        if self.thread is not None:
+            self.thread.join(self.flush_interval + 1)
+            self.thread = None
+        self.flush()
+
+    def after_fork(self):
+        self.thread = None
+        self.finished = []
+
+    def run(self):
+        while self.running:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        with self.mutex:
+            spans, self.finished = self.finished, []
+        if spans:
+            try:
+                self.sink.export(spans)
+            except Exception:
+                self.logger.exception('Failed to export %d spans', len(spans))
+
+
+class SpanScope:
+
+    def __init__(self, tracer, name, kind, tags):
+        self.tracer = tracer
+        self.name = name
+        self.kind = kind
+        self.tags = tags
+        self.span = None
+
+    def __enter__(self):
+        spans = self.tracer.stack.get()
+        if spans:
+            parent = spans[-1]
+            self.span = Span(
+                parent.trace_id, parent.span_id, self.name, self.kind,
+                self.tags)
+            spans.append(self.span)
+        return self.span
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.span is None:
+            return
+        spans = self.tracer.stack.get() or []
+        if self.span in spans:
+            spans.remove(self.span)
+        if exc_type is not None:
+            self.span.tags['error'] = exc_type.__name__
+        self.span.finish()
+        self.tracer.export(self.span)
+
+
+class NoSpan:
+
+    def __enter__(self):
+        return None
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+no_span = NoSpan()
+
+
+def span(mesh, name, kind, **tags):
+    tracer = getattr(mesh, 'tracer', None)
+    if tracer is None:
+        return no_span
+    return tracer.span(name, kind, **tags)
+
+
+class JSONLSink:
+
+    def __init__(self, path):
+        self.path = path
+
+    def export(self, spans):
+        with open(self.path, 'a') as fp:
+            for span in spans:
+                fp.write(json.dumps(span.as_dict(), default=str))
+                fp.write('\n')
+
+
+class InfluxSink:
+
+    def __init__(self, influx):
+        self.influx = influx
+
+    def export(self, spans):
+        for span in spans:
+            self.influx.write('span', {
+                'name': span.name,
+                'kind': span.kind,
+            }, {
+                'trace_id': span.trace_id,
+                'span_id': span.span_id,
+                'parent_id': span.parent_id or '',
+                'duration': span.duration,
+            }, time=int(span.timestamp * 1e9))
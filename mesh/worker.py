@@ -0,0 +1,154 @@
+import argparse
+import asyncio
+import inspect
+import os
+
+from functools import partial
+from importlib import import_module
+from signal import SIG_DFL, SIGINT, SIGKILL, SIGTERM, signal
+from time import monotonic, sleep
+
+
+class Supervisor:
+
+    # Forks worker processes after the application is set up and
+    # keeps their number constant until stopped.
+
+    restart_delay = 1
+
+    def __init__(self, mesh, target, processes=None, shutdown_timeout=30):
+        self.mesh = mesh
+        self.logger = mesh.init_logger()
+        self.target = target
+        self.processes = processes or os.cpu_count() or 1
+        self.shutdown_timeout = shutdown_timeout
+        self.children = {}
+        self.workers = {}
+        self.running = False
+
+    def run(self):
+        self.running = True
+        signal(SIGINT, self.stop)
+        signal(SIGTERM, self.stop)
+
+        while self.running:
+            while len(self.children) < self.processes:
+                self.spawn()
+            self.reap()
+            sleep(0.5)
+
+        self.shutdown()
+
+    def stop(self, signo=None, frame=None):
+        self.running = False
+
+    def spawn(self):
+        # Workers are numbered, so that they can tell apart resources
+        # such as the ports of their metrics servers.
+        worker = min(set(range(self.processes)) - set(self.workers.values()))
+        pid = os.fork()
+        if pid == 0:
+            signal(SIGINT, SIG_DFL)
+            signal(SIGTERM, SIG_DFL)
+            status = 0
+            try:
+                self.mesh.after_fork(worker)
+                self.target()
+            except BaseException:
+                self.logger.exception('Worker failed')
+                status = 1
+            try:
+                self.mesh.close()
+            except BaseException:
+                self.logger.exception('Worker shutdown failed')
+                status = 1
+            finally:
+                os._exit(status)
+        self.children[pid] = monotonic()
+        self.workers[pid] = worker
+        self.logger.info('Started worker %d', pid)
+
+    def reap(self):
+        while self.children:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if pid == 0:
+                return
+            started = self.children.pop(pid, None)
+            self.workers.pop(pid, None)
+            if started is None:
+                continue
+            if os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0:
+                self.logger.info('Worker %d exited', pid)
+            else:
+                self.logger.warning(
+                    'Worker %d failed with status %d', pid, status)
+                # Do not fork in a tight loop when workers crash at
+                # startup.
+                if self.running and monotonic() - started < 1:
+                    sleep(self.restart_delay)
+
+    def shutdown(self):
+        for pid in self.children:
+            os.kill(pid, SIGTERM)
+        deadline = monotonic() + self.shutdown_timeout
+        while self.children and monotonic() < deadline:
+            self.reap()
+            sleep(0.1)
+        for pid in self.children:
+            self.logger.warning('Killing worker %d', pid)
+            os.kill(pid, SIGKILL)
+        while self.children:
+            pid, __ = os.waitpid(-1, 0)
+            self.children.pop(pid, None)
+            self.workers.pop(pid, None)
+
+
+def run_worker(mesh, service='amqp', processes=None, max_messages=None):
+    if service == 'cron':
+        run = mesh.init_cron().run
+    else:
+        amqp = mesh.init_amqp()
+        if amqp is None:
+            raise RuntimeError('AMQP workers require AMQP_DSN')
+        if max_messages is not None:
+            amqp.max_messages = max_messages
+        run = amqp.run
+    Supervisor(mesh, partial(start, run), processes).run()
+
+
+def start(run):
+    # Asynchronous workers get an event loop in the child process.
+    if inspect.iscoroutinefunction(run):
+        asyncio.run(run())
+    else:
+        run()
+
+
+def load_mesh(name):
+    module_name, __, attr = name.partition(':')
+    obj = getattr(import_module(module_name), attr or 'mesh')
+    extensions = getattr(obj, 'extensions', None)
+    if extensions is not None:
+        obj = extensions['mesh']
+    return obj
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='mesh')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    worker = commands.add_parser('worker', help='Run worker processes')
+    worker.add_argument(
+        'app', help='Mesh instance or Flask application as module:name')
+    worker.add_argument(
+        'service', nargs='?', choices=('amqp', 'cron'), default='amqp')
+    worker.add_argument('-p', '--processes', type=int)
+    worker.add_argument('--max-messages', type=int)
+
+    args = parser.parse_args(argv)
+    run_worker(
+        load_mesh(args.app),
+        service=args.service,
+        processes=args.processes,
+        max_messages=args.max_messages)
@@ -5,9 +5,12 @@ setup(
     version='3.5',
     description='Service mesh',
     packages=['mesh'],
+    entry_points={
+        'console_scripts': ['mesh = mesh.worker:main'],
+    },
     extras_require={
         'amqp': ['kombu>=4.1'],
-        'cron': ['schedule>=0.5'],
+        'cron': [],
         'db': ['sqlalchemy>=1.1'],
         'http': ['requests>=2.12'],
         'influx': ['influxdb>=5.0'],
@@ -0,0 +1,116 @@
+from collections import defaultdict
+from itertools import count
+from kombu import Connection
+from kombu.transport import TRANSPORT_ALIASES, memory
+from pytest import fixture
+from signal import SIGINT, SIGTERM, getsignal, signal
+
+
+class Broker:
+
+    # Records what the workers sent to the broker.
+
+    dsn = 'mesh-memory://'
+
+    def __init__(self):
+        self.acks = []
+        self.rejects = []
+        self.nacked = set()
+        self.declared = {}
+
+    def get(self, queue):
+        with Connection(self.dsn) as connection:
+            message = connection.default_channel.basic_get(queue, no_ack=True)
+        return message
+
+
+class Channel(memory.Channel):
+
+    # Deliveries of the memory transport lack the consumer tag and
+    # number delivery tags with UUIDs rather than per channel. It has
+    # no publisher confirms either; here they arrive with the next
+    # events, and publishes to routing keys in broker.nacked are
+    # nacked and dropped.
+
+    broker = None
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.delivery_tags = count(1)
+        self.events = defaultdict(set)
+        self.publish_tags = None
+        self.unconfirmed = []
+
+    def confirm_select(self, nowait=False):
+        self.publish_tags = count(1)
+
+    def basic_publish(self, message, exchange, routing_key, **kwargs):
+        if self.publish_tags is None:
+            return super().basic_publish(
+                message, exchange, routing_key, **kwargs)
+        if routing_key in self.broker.nacked:
+            self.unconfirmed.append(('basic_nack', next(self.publish_tags)))
+            return
+        super().basic_publish(message, exchange, routing_key, **kwargs)
+        self.unconfirmed.append(('basic_ack', next(self.publish_tags)))
+
+    def confirm(self):
+        unconfirmed, self.unconfirmed = self.unconfirmed, []
+        for event, delivery_tag in unconfirmed:
+            for callback in list(self.events[event]):
+                callback(delivery_tag, False)
+        return bool(unconfirmed)
+
+    def basic_consume(self, queue, no_ack, callback, consumer_tag, **kwargs):
+        super().basic_consume(queue, no_ack, callback, consumer_tag, **kwargs)
+        receive = self.connection._callbacks[queue]
+
+        def deliver(raw_message):
+            properties = raw_message['properties']
+            properties['delivery_tag'] = next(self.delivery_tags)
+            properties['delivery_info']['consumer_tag'] = consumer_tag
+            return receive(raw_message)
+
+        self.connection._callbacks[queue] = deliver
+
+    def queue_declare(self, queue=None, passive=False, **kwargs):
+        self.broker.declared[queue] = kwargs.get('arguments')
+        return super().queue_declare(queue, passive, **kwargs)
+
+    def basic_ack(self, delivery_tag, multiple=False):
+        self.broker.acks.append((delivery_tag, multiple))
+        tags = [delivery_tag]
+        if multiple:
+            tags = [tag for tag in self.qos._delivered if tag <= delivery_tag]
+        for tag in tags:
+            super().basic_ack(tag)
+
+    def basic_reject(self, delivery_tag, requeue=False):
+        self.broker.rejects.append((delivery_tag, requeue))
+        super().basic_reject(delivery_tag, requeue=requeue)
+
+
+class Transport(memory.Transport):
+
+    Channel = Channel
+    polling_interval = 0.01
+
+    def drain_events(self, connection, timeout=None):
+        if any([channel.confirm() for channel in self.channels]):
+            return
+        return super().drain_events(connection, timeout)
+
+
+TRANSPORT_ALIASES['mesh-memory'] = lambda: Transport
+
+
+@fixture
+def broker():
+    broker = Channel.broker = Broker()
+    memory.Channel.queues.clear()
+    Transport.global_state.clear()
+    # Workers install signal handlers, which must not outlive the test.
+    handlers = {signo: getsignal(signo) for signo in (SIGINT, SIGTERM)}
+    yield broker
+    for signo, handler in handlers.items():
+        signal(signo, handler)
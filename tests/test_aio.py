@@ -0,0 +1,134 @@
+import asyncio
+
+from kombu import Connection, Producer
+from mesh import Mesh
+from threading import current_thread
+from time import monotonic, sleep
+
+
+def make_amqp(broker, **config):
+    mesh = Mesh(dict(config, AMQP_DSN=broker.dsn))
+    amqp = mesh.init_async_amqp()
+    consumer = amqp.init_consumer()
+    for name in ('jobs', 'results'):
+        amqp.make_queue(name=name).declare()
+    consumer.add_queue(amqp.make_queue(name='jobs'))
+    return amqp
+
+
+def publish(amqp, payloads):
+    with amqp.mesh.make_context():
+        session = amqp.acquire_session()
+        for payload in payloads:
+            session.add(routing_key='jobs', type='job', json=payload)
+        session.commit()
+
+
+def receive(broker, queue, count, timeout=2):
+    messages = []
+    deadline = monotonic() + timeout
+    while len(messages) < count and monotonic() < deadline:
+        message = broker.get(queue)
+        if message is None:
+            sleep(0.01)
+        else:
+            messages.append(message)
+    return messages
+
+
+class TestAsyncAMQP:
+    """
+    Feature: Asyncio workers
+    """
+
+    def test_concurrency(self, broker):
+        """Scenario: Coroutine tasks run concurrently on the loop"""
+        amqp = make_amqp(broker, AMQP_MAX_MESSAGES='10')
+        running = 0
+        peak = 0
+
+        @amqp.task('job')
+        async def job(message):
+            nonlocal running, peak
+            running += 1
+            peak = max(peak, running)
+            await asyncio.sleep(0.05)
+            running -= 1
+            if message.payload == 0:
+                raise ValueError('Failed')
+
+        publish(amqp, range(10))
+        asyncio.run(amqp.run())
+        assert peak > 1
+        assert amqp.consumers['default'].prefetch_count == 100
+        assert len(broker.acks) == 9
+        assert len(broker.rejects) == 1
+
+    def test_session(self, broker):
+        """Scenario: Sessions are acquired off the event loop"""
+        amqp = make_amqp(
+            broker, AMQP_MAX_MESSAGES='3', AMQP_POOL_SIZE='1',
+            AMQP_CONCURRENCY='3')
+        publish(amqp, range(3))
+        acquired = []
+        acquire_session = amqp.acquire_session
+
+        def record():
+            acquired.append(current_thread().name)
+            return acquire_session()
+
+        amqp.acquire_session = record
+
+        @amqp.task('job')
+        async def job(message):
+            session = await amqp.session
+            assert session is await amqp.session
+            session.add(routing_key='results', json=message.payload)
+            await asyncio.sleep(0.05)
+            await session.commit()
+
+        asyncio.run(amqp.run())
+        results = receive(broker, 'results', 3)
+        assert amqp.pool.size == 3
+        assert broker.rejects == []
+        assert len(acquired) == 3
+        assert current_thread().name not in acquired
+        assert sorted(message.payload for message in results) == [0, 1, 2]
+
+    def test_idempotent(self, broker):
+        """Scenario: Redelivered messages of idempotent tasks run once"""
+        amqp = make_amqp(
+            broker, AMQP_MAX_MESSAGES='3', AMQP_CONCURRENCY='1')
+        payloads = []
+
+        @amqp.task('job', idempotent=True)
+        async def job(message):
+            payloads.append(message.payload)
+
+        with Connection(broker.dsn) as connection:
+            producer = Producer(connection.channel())
+            for payload, message_id in ((1, 'a'), (1, 'a'), (2, 'b')):
+                producer.publish(
+                    payload, routing_key='jobs', type='job',
+                    message_id=message_id)
+        asyncio.run(amqp.run())
+        assert sorted(payloads) == [1, 2]
+        assert len(broker.acks) == 3
+
+    def test_batch_split(self, broker):
+        """Scenario: Failed batches are retried message by message"""
+        amqp = make_amqp(broker, AMQP_MAX_MESSAGES='3')
+        batches = []
+
+        @amqp.task('job', batch_size=3, on_error='split')
+        async def job(messages):
+            payloads = [message.payload for message in messages]
+            batches.append(payloads)
+            if 0 in payloads:
+                raise ValueError('Failed')
+
+        publish(amqp, range(3))
+        asyncio.run(amqp.run())
+        assert batches == [[0, 1, 2], [0], [1], [2]]
+        assert len(broker.acks) == 2
+        assert len(broker.rejects) == 1
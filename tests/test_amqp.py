@@ -1,4 +1,10 @@
+from concurrent.futures import wait
+from kombu import Connection, Producer
 from mesh import Mesh
+from mesh.amqp import PublishError, Retry
+from pytest import importorskip
+from threading import Thread, current_thread
+from time import monotonic, sleep
 from uuid import uuid4
 
 
@@ -47,3 +53,399 @@ def test_amqp():
 
     amqp.run()
     assert received
+
+
+def make_amqp(broker, queue='jobs', **config):
+    mesh = Mesh(dict(config, AMQP_DSN=broker.dsn))
+    amqp = mesh.init_amqp()
+    consumer = amqp.init_consumer()
+    queue = amqp.make_queue(name=queue)
+    queue.declare()
+    consumer.add_queue(queue)
+    return amqp
+
+
+def publish(amqp, payloads, routing_key='jobs', type='job', **kwargs):
+    with amqp.mesh.make_context():
+        for payload in payloads:
+            amqp.session.add(
+                routing_key=routing_key, type=type, json=payload, **kwargs)
+        amqp.session.commit()
+
+
+def respond(broker, count):
+    # Answers requests in reverse order once all of them arrived.
+    # Requests for zero get no answer.
+    def run():
+        with Connection(broker.dsn) as connection:
+            channel = connection.channel()
+            requests = []
+            deadline = monotonic() + 5
+            while len(requests) < count and monotonic() < deadline:
+                message = channel.basic_get('rpc', no_ack=True)
+                if message is None:
+                    sleep(0.01)
+                else:
+                    requests.append(message)
+            producer = Producer(channel)
+            for message in reversed(requests):
+                if message.payload:
+                    producer.publish(
+                        message.payload * 2,
+                        routing_key=message.properties['reply_to'],
+                        correlation_id=message.properties['correlation_id'])
+
+    thread = Thread(target=run, daemon=True)
+    thread.start()
+    return thread
+
+
+class TestWorkers:
+    """
+    Feature: Worker thread pool
+    """
+
+    def test_dispatch(self, broker):
+        """Scenario: Messages are handled by workers and acked"""
+        amqp = make_amqp(broker, AMQP_WORKERS='4', AMQP_MAX_MESSAGES='20')
+        threads = set()
+
+        @amqp.task('job')
+        def job(message):
+            threads.add(current_thread().name)
+            sleep(0.01)
+            if message.payload == 0:
+                raise ValueError('Failed')
+
+        publish(amqp, range(20))
+        amqp.run()
+        assert len(threads) > 1
+        assert all(name.startswith('amqp') for name in threads)
+        assert len(broker.acks) == 19
+        assert broker.rejects == [(1, False)]
+
+    def test_inline(self, broker):
+        """Scenario: Without workers, messages are handled in order"""
+        amqp = make_amqp(broker, AMQP_MAX_MESSAGES='5')
+        payloads = []
+
+        @amqp.task('job')
+        def job(message):
+            payloads.append(message.payload)
+
+        publish(amqp, range(5))
+        amqp.run()
+        assert payloads == list(range(5))
+        assert [tag for tag, __ in broker.acks] == [1, 2, 3, 4, 5]
+
+
+class TestReplies:
+    """
+    Feature: Replies to requests
+    """
+
+    def make_amqp(self, broker):
+        amqp = Mesh({'AMQP_DSN': broker.dsn}).init_amqp()
+        amqp.make_queue(name='rpc').declare()
+        return amqp
+
+    def test_request_many(self, broker):
+        """Scenario: Replies arriving out of order are matched"""
+        amqp = self.make_amqp(broker)
+        respond(broker, 3)
+        with amqp.mesh.make_context():
+            replies = amqp.session.request_many(
+                [{'routing_key': 'rpc', 'json': n} for n in (1, 2, 3)],
+                timeout=5)
+        assert [reply.payload for reply in replies] == [2, 4, 6]
+
+    def test_deadline(self, broker):
+        """Scenario: Requests without a reply give None at the deadline"""
+        amqp = self.make_amqp(broker)
+        respond(broker, 2)
+        started = monotonic()
+        with amqp.mesh.make_context():
+            replies = amqp.session.request_many(
+                [{'routing_key': 'rpc', 'json': n} for n in (1, 0)],
+                timeout=0.5)
+            pending = dict(amqp.session.replies)
+        assert 0.5 <= monotonic() - started < 2
+        assert replies[0].payload == 2
+        assert replies[1] is None
+        assert pending == {}
+
+    def test_background(self, broker):
+        """Scenario: Replies resolve without waiting on them"""
+        amqp = self.make_amqp(broker)
+        respond(broker, 2)
+        with amqp.mesh.make_context():
+            session = amqp.session
+            first = session.publish(
+                routing_key='rpc', json=1, reply_to=session.reply_queue)
+            second = session.publish(
+                routing_key='rpc', json=2, reply_to=session.reply_queue)
+            done, __ = wait([first, second], timeout=5)
+        assert done == {first, second}
+        assert second.result().payload == 4
+
+    def test_publish_while_pending(self, broker):
+        """Scenario: Publishing is not held up by pending replies"""
+        amqp = self.make_amqp(broker)
+        amqp.make_queue(name='jobs').declare()
+        with amqp.mesh.make_context():
+            session = amqp.session
+            reply = session.publish(
+                routing_key='rpc', json=0, reply_to=session.reply_queue)
+            sleep(0.1)
+            started = monotonic()
+            for n in range(50):
+                session.publish(routing_key='jobs', json=n)
+            elapsed = monotonic() - started
+            session.discard(reply)
+        assert elapsed < 0.03
+
+
+class TestPool:
+    """
+    Feature: Session pool
+    """
+
+    def make_pool(self, broker, **config):
+        return make_amqp(broker, **config).pool
+
+    def test_bounds(self, broker):
+        """Scenario: Acquiring waits for a free session up to a timeout"""
+        pool = self.make_pool(broker, AMQP_POOL_SIZE='2')
+        first, second = pool.acquire(), pool.acquire()
+        try:
+            pool.acquire(timeout=0.05)
+        except TimeoutError:
+            exhausted = True
+        else:
+            exhausted = False
+        thread = Thread(target=lambda: (sleep(0.1), pool.release(first)))
+        thread.start()
+        third = pool.acquire(timeout=2)
+        thread.join()
+        stats = pool.stats()
+        assert exhausted
+        assert third is first
+        assert stats['in_use'] == 2
+        assert stats['created'] == 2
+        assert stats['waits'] == 1
+        assert stats['wait_time'] >= 0.1
+
+    def test_eviction(self, broker):
+        """Scenario: Sessions idle for too long are closed"""
+        pool = self.make_pool(broker, AMQP_POOL_IDLE_TIMEOUT='0.05')
+        session = pool.acquire()
+        pool.release(session)
+        assert pool.acquire() is session
+        pool.release(session)
+        sleep(0.1)
+        fresh = pool.acquire()
+        stats = pool.stats()
+        assert fresh is not session
+        assert session.channel.closed
+        assert stats['created'] == 2
+        assert stats['evicted'] == 1
+        assert stats['idle'] == 0
+        assert pool.links[0].sessions == 1
+
+
+class TestConfirms:
+    """
+    Feature: Publisher confirms
+    """
+
+    def test_confirm(self, broker):
+        """Scenario: Commit returns once the broker confirmed the batch"""
+        amqp = make_amqp(broker, AMQP_CONFIRM='1')
+        publish(amqp, range(3))
+        assert [broker.get('jobs').payload for __ in range(3)] == [0, 1, 2]
+
+    def test_nack(self, broker):
+        """Scenario: Nacked messages are kept and sent again on revive"""
+        amqp = make_amqp(broker, AMQP_CONFIRM='1', AMQP_CONFIRM_TIMEOUT='1')
+        broker.nacked.add('jobs')
+        errors = []
+        with amqp.mesh.make_context():
+            session = amqp.session
+            session.add(routing_key='other', json='kept')
+            session.add(routing_key='jobs', json='nacked')
+            try:
+                session.commit()
+            except PublishError as error:
+                errors.append(error)
+            failed = list(session.failed)
+            broker.nacked.clear()
+            session.revive()
+            remaining = list(session.failed)
+        assert [len(error.messages) for error in errors] == [1]
+        assert [message['body'] for message in failed] == ['"nacked"']
+        assert remaining == []
+        assert broker.get('other').payload == 'kept'
+        assert broker.get('jobs').payload == 'nacked'
+
+
+class TestBatches:
+    """
+    Feature: Batch consumers
+    """
+
+    def test_flush(self, broker):
+        """Scenario: Batches flush when full or after the maximum wait"""
+        amqp = make_amqp(broker)
+        batches = []
+
+        @amqp.task('job', batch_size=3, max_wait=50)
+        def job(messages):
+            batches.append([message.payload for message in messages])
+            if sum(map(len, batches)) == 5:
+                amqp.stop()
+
+        publish(amqp, range(5))
+        amqp.run()
+        assert batches == [[0, 1, 2], [3, 4]]
+        assert broker.acks == [(3, True), (5, True)]
+
+    def test_prefetch(self, broker):
+        """Scenario: Batches fill up beyond the prefetch of the workers"""
+        amqp = make_amqp(broker, AMQP_WORKERS='2', AMQP_MAX_MESSAGES='10')
+        batches = []
+
+        @amqp.task('job', batch_size=5, max_wait=5000)
+        def job(messages):
+            batches.append(len(messages))
+
+        publish(amqp, range(10))
+        started = monotonic()
+        amqp.run()
+        assert batches == [5, 5]
+        assert amqp.consumers['default'].prefetch_count == 7
+        assert monotonic() - started < 1
+
+    def test_stop(self, broker):
+        """Scenario: A partial batch is flushed and acked on stop"""
+        amqp = make_amqp(broker, AMQP_MAX_MESSAGES='2')
+        batches = []
+
+        @amqp.task('job', batch_size=5)
+        def job(messages):
+            batches.append([message.payload for message in messages])
+
+        publish(amqp, range(2))
+        amqp.run()
+        assert batches == [[0, 1]]
+        assert broker.acks == [(2, True)]
+
+    def test_outstanding(self, broker):
+        """Scenario: Batches are acked one by one below a pending message"""
+        amqp = make_amqp(
+            broker, AMQP_WORKERS='2', AMQP_PREFETCH_COUNT='3',
+            AMQP_MAX_MESSAGES='3')
+
+        @amqp.task('slow')
+        def slow(message):
+            sleep(0.2)
+
+        @amqp.task('job', batch_size=2)
+        def job(messages):
+            pass
+
+        publish(amqp, ['slow'], type='slow')
+        publish(amqp, range(2))
+        amqp.run()
+        assert sorted(broker.acks) == [(1, False), (2, False), (3, False)]
+
+    def test_split(self, broker):
+        """Scenario: A failed batch is retried message by message"""
+        amqp = make_amqp(broker, AMQP_MAX_MESSAGES='3')
+        handled = []
+
+        @amqp.task('job', batch_size=3, on_error='split')
+        def job(messages):
+            payloads = [message.payload for message in messages]
+            handled.append(payloads)
+            if 1 in payloads:
+                raise ValueError('Failed')
+
+        publish(amqp, range(3))
+        amqp.run()
+        assert handled == [[0, 1, 2], [0], [1], [2]]
+        assert broker.acks == [(1, True), (3, True)]
+        assert broker.rejects == [(2, False)]
+
+
+class TestEncoding:
+    """
+    Feature: Message serialization and compression
+    """
+
+    def test_serializer(self, broker):
+        """Scenario: Messages are serialized with the configured format"""
+        importorskip('msgpack')
+        amqp = make_amqp(
+            broker, AMQP_SERIALIZER='msgpack', AMQP_MAX_MESSAGES='1')
+        payloads = []
+
+        @amqp.task('job')
+        def job(message):
+            payloads.append((message.content_type, message.payload))
+
+        publish(amqp, [{'id': 1, 'tags': ['a']}])
+        amqp.run()
+        assert payloads == [
+            ('application/x-msgpack', {'id': 1, 'tags': ['a']})]
+
+    def test_compression(self, broker):
+        """Scenario: Only bodies over the threshold are compressed"""
+        amqp = make_amqp(
+            broker, AMQP_COMPRESSION='gzip', AMQP_COMPRESSION_THRESHOLD='100')
+        publish(amqp, ['small', 'large' * 100])
+        small, large = broker.get('jobs'), broker.get('jobs')
+        assert 'compression' not in small.headers
+        assert large.headers['compression'] == 'application/x-gzip'
+        assert (small.payload, large.payload) == ('small', 'large' * 100)
+
+
+class TestRetry:
+    """
+    Feature: Delayed retries
+    """
+
+    def test_delay_queue(self, broker):
+        """Scenario: Failed messages wait in an expiring delay queue"""
+        amqp = make_amqp(broker, AMQP_MAX_MESSAGES='1')
+
+        @amqp.task('job', retry=Retry(attempts=3, delay=2, jitter=0))
+        def job(message):
+            raise ValueError('Failed')
+
+        publish(amqp, ['retried'])
+        amqp.run()
+        message = broker.get('jobs.retry.2000')
+        assert message.payload == 'retried'
+        assert message.headers['x-mesh-attempts'] == 1
+        assert broker.declared['jobs.retry.2000'] == {
+            'x-message-ttl': 2000,
+            'x-dead-letter-exchange': '',
+            'x-dead-letter-routing-key': 'jobs',
+            'x-expires': 3602000,
+        }
+        assert broker.acks == [(1, False)]
+
+    def test_confirmed(self, broker):
+        """Scenario: Messages are only acked once the retry is confirmed"""
+        amqp = make_amqp(broker, AMQP_CONFIRM='1', AMQP_MAX_MESSAGES='1')
+        broker.nacked.add('jobs.retry.1000')
+
+        @amqp.task('job', retry=Retry(jitter=0))
+        def job(message):
+            raise ValueError('Failed')
+
+        publish(amqp, ['retried'])
+        amqp.run()
+        assert broker.get('jobs.retry.1000') is None
+        assert broker.acks == []
+        assert broker.rejects == [(1, False)]
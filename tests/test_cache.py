@@ -0,0 +1,52 @@
+from mesh import Mesh
+from mesh.cache import LRUCache
+from mesh.dedup import Dedup
+from time import sleep
+
+
+class TestLRUCache:
+    """
+    Feature: Bounded cache
+    """
+
+    def test_eviction(self):
+        """Scenario: Least recently used keys are evicted"""
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        assert cache.get('a') == 1
+        cache.set('c', 3)
+        assert 'b' not in cache
+        assert cache.get('a') == 1
+        assert cache.get('c') == 3
+
+    def test_ttl(self):
+        """Scenario: Expired keys are missing"""
+        cache = LRUCache(10, ttl=0.01)
+        cache.set('a', 1)
+        sleep(0.02)
+        assert cache.get('a') is None
+        assert cache.stats()['misses'] == 1
+
+
+class TestDedup:
+    """
+    Feature: Message deduplication
+    """
+
+    def test_memory(self):
+        """Scenario: Processed message IDs are remembered"""
+        dedup = Dedup(Mesh({}))
+        assert not dedup.seen('a')
+        dedup.mark('a')
+        assert dedup.seen('a')
+        assert not dedup.seen(None)
+        assert dedup.stats()['hits'] == 1
+
+    def test_sqlite(self, tmpdir):
+        """Scenario: Processed message IDs are shared through SQLite"""
+        config = {'AMQP_DEDUP_BACKEND': str(tmpdir.join('dedup.db'))}
+        Dedup(Mesh(config)).mark('a')
+        dedup = Dedup(Mesh(config))
+        assert dedup.seen('a')
+        assert not dedup.seen('b')
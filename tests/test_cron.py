@@ -0,0 +1,111 @@
+from datetime import datetime, timedelta
+from mesh import Mesh
+from mesh.cron import Crontab, Interval, Job, Scheduler
+from pytest import raises
+from threading import Event
+
+
+class TestTriggers:
+    """
+    Feature: Cron triggers
+    """
+
+    def test_crontab(self):
+        """Scenario: Crontab expressions give the next matching minute"""
+        now = datetime(2024, 1, 31, 10, 15, 30)
+        expected = {
+            '*/20 * * * *': datetime(2024, 1, 31, 10, 20),
+            '0 9 * * mon-fri': datetime(2024, 2, 1, 9, 0),
+            '@monthly': datetime(2024, 2, 1, 0, 0),
+            '30 6 29 feb *': datetime(2024, 2, 29, 6, 30),
+        }
+        for expression, time in expected.items():
+            assert Crontab(expression).next(now) == time
+
+    def test_interval(self):
+        """Scenario: Interval triggers keep their original phase"""
+        now = datetime(2024, 1, 31, 10, 15, 30)
+        trigger = Interval(1, 'day', '09:00')
+        assert trigger.next(now) == datetime(2024, 2, 1, 9, 0)
+        assert trigger.next(datetime(2024, 2, 3, 12, 0)) == \
+            datetime(2024, 2, 4, 9, 0)
+        assert Interval(1, 'sunday').next(now) == datetime(2024, 2, 4, 0, 0)
+
+    def test_hourly_interval(self):
+        """Scenario: Hourly intervals take the minute of their start time"""
+        now = datetime(2024, 1, 1, 11, 0)
+        trigger = Interval(1, 'hour', '00:30')
+        assert trigger.next(now) == datetime(2024, 1, 1, 11, 30)
+        assert trigger.next(datetime(2024, 1, 1, 12, 0)) == \
+            datetime(2024, 1, 1, 12, 30)
+        assert Interval(1, 'hour', '00:30', aligned=True).next(now) == \
+            datetime(2024, 1, 1, 11, 30)
+        with raises(ValueError):
+            Interval(5, 'minutes', '00:30')
+
+    def test_aligned_interval(self):
+        """Scenario: Aligned intervals agree across replica start dates"""
+        fire_times = {
+            Interval(2, 'days', '10:00', aligned=True).next(start)
+            for start in (datetime(2024, 1, 30, 12, 0),
+                          datetime(2024, 1, 31, 9, 0))}
+        assert fire_times == {datetime(2024, 2, 1, 10, 0)}
+        trigger = Interval(2, 'sunday', aligned=True)
+        first = trigger.next(datetime(2024, 1, 31))
+        assert first.weekday() == 6
+        assert trigger.next(first + timedelta(days=1)) == \
+            first + timedelta(weeks=2)
+
+
+class TestScheduler:
+    """
+    Feature: Cron scheduler
+    """
+
+    def test_overlap(self):
+        """Scenario: Running jobs are not started again"""
+        scheduler = Scheduler(Mesh({}))
+        started, release = Event(), Event()
+        calls = []
+
+        def slow():
+            calls.append(1)
+            started.set()
+            release.wait(1)
+
+        now = datetime.now()
+        job = Job(slow, Interval(1, 'second'))
+        scheduler.add(job, now)
+        scheduler.run_pending(now + timedelta(seconds=1))
+        started.wait(1)
+        scheduler.run_pending(now + timedelta(seconds=2))
+        release.set()
+        scheduler.shutdown()
+        assert calls == [1]
+        assert len(scheduler.jobs) == 1
+
+    def test_catchup(self):
+        """Scenario: Missed runs are caught up once"""
+        scheduler = Scheduler(Mesh({}))
+        now = datetime(2024, 1, 1)
+        job = Job(print, Interval(1, 'minute'), catchup='once')
+        scheduler.add(job, now)
+        firings, next_time = scheduler.catch_up(
+            job, now + timedelta(minutes=1), now + timedelta(minutes=10))
+        assert firings == [now + timedelta(minutes=1)]
+        assert next_time == now + timedelta(minutes=11)
+        job.catchup = 'all'
+        firings, __ = scheduler.catch_up(
+            job, now + timedelta(minutes=1), now + timedelta(minutes=10))
+        assert len(firings) == 10
+
+    def test_lease(self, tmpdir):
+        """Scenario: Each firing runs on one replica only"""
+        config = {'DB_DSN': f"sqlite:///{tmpdir.join('cron.db')}"}
+        calls = []
+        job = Job(lambda: calls.append(1), Interval(1, 'minute'), lease=True)
+        fire_time = datetime(2024, 1, 1, 12, 0)
+        for replica in range(3):
+            Scheduler(Mesh(config))._run_job(job, fire_time)
+        Scheduler(Mesh(config))._run_job(job, fire_time + timedelta(minutes=1))
+        assert calls == [1, 1]
@@ -0,0 +1,164 @@
+import logging
+import sqlalchemy as sa
+
+from mesh import Config, Mesh
+from mesh.db import DB
+from pytest import fixture
+
+
+@fixture
+def config(tmpdir):
+    return {'DB_DSN': f"sqlite:///{tmpdir.join('primary.db')}"}
+
+
+@fixture
+def mesh(config):
+    return Mesh(config)
+
+
+@fixture
+def db(mesh):
+    db = mesh.init_db()
+
+    class Item(db.Model):
+        __tablename__ = 'item'
+        id = sa.Column(sa.Integer, primary_key=True)
+        name = sa.Column(sa.String)
+
+    for engine in db.engine, *db.replicas:
+        db.Model.metadata.create_all(engine)
+    db.Item = Item
+    return db
+
+
+class TestReplicas:
+    """
+    Feature: Read replica routing
+    """
+
+    @fixture
+    def config(self, tmpdir):
+        return {
+            'DB_DSN': f"sqlite:///{tmpdir.join('primary.db')}",
+            'DB_REPLICA_DSNS': f"sqlite:///{tmpdir.join('replica.db')}",
+        }
+
+    def test_routing(self, mesh, db):
+        """Scenario: Reads go to the replica until the session writes"""
+        with db.replicas[0].begin() as connection:
+            connection.execute(db.Item.__table__.insert(), {'name': 'copy'})
+
+        def names():
+            return [item.name for item in db.Item.query]
+
+        # Contexts log and swallow exceptions, so results are checked
+        # outside of them.
+        reads = []
+        with mesh.make_context():
+            reads.append(names())
+            db.session.add(db.Item(name='new'))
+            db.session.flush()
+            reads.append(names())
+            db.session.commit()
+            reads.append(names())
+        assert reads == [['copy'], ['new'], ['copy']]
+
+    def test_core_writes(self, mesh, db):
+        """Scenario: Reads go to the primary after a bulk insert"""
+        reads = []
+        with mesh.make_context():
+            db.bulk_insert(db.Item, [{'name': 'new'}])
+            reads.append([item.name for item in db.Item.query])
+            db.session.rollback()
+            reads.append([item.name for item in db.Item.query])
+        assert reads == [['new'], []]
+
+
+class TestOptions:
+    """
+    Feature: Engine options
+    """
+
+    def test_statement_timeout(self, tmpdir):
+        """Scenario: The statement timeout only applies to PostgreSQL"""
+        options = DB.engine_options(Config({
+            'DB_DSN': 'postgresql://localhost/mesh',
+            'DB_STATEMENT_TIMEOUT': '5000',
+        }))
+        assert options['connect_args'] == {
+            'options': '-c statement_timeout=5000'}
+        mesh = Mesh({
+            'DB_DSN': f"sqlite:///{tmpdir.join('primary.db')}",
+            'DB_STATEMENT_TIMEOUT': '5000',
+        })
+        db = mesh.init_db()
+        with mesh.make_context():
+            result = db.session.execute(sa.text('SELECT 1')).scalar()
+        assert result == 1
+
+
+class TestBulk:
+    """
+    Feature: Bulk writes and streaming reads
+    """
+
+    def test_upsert(self, mesh, db):
+        """Scenario: Rows are inserted, upserted and streamed back"""
+        with mesh.make_context():
+            db.bulk_insert(db.Item, [{'id': 1, 'name': 'a'}], chunk_size=2)
+            db.bulk_upsert(
+                db.Item,
+                ({'id': id, 'name': 'b'} for id in range(1, 6)),
+                chunk_size=2)
+            db.session.commit()
+            items = db.Item.query.order_by(db.Item.id).stream(2)
+            rows = [(item.id, item.name) for item in items]
+        assert rows == [(id, 'b') for id in range(1, 6)]
+
+
+class TestQueryCache:
+    """
+    Feature: Query result cache
+    """
+
+    def test_invalidation(self, mesh, db):
+        """Scenario: Cached results are dropped when their table is written"""
+        with mesh.make_context():
+            db.bulk_insert(db.Item, [{'id': 1, 'name': 'a'}])
+            db.session.commit()
+
+        def names():
+            with mesh.make_context():
+                query = db.Item.query.filter(db.Item.id > 0).cached()
+                return [item.name for item in query]
+
+        assert names() == ['a']
+        assert names() == ['a']
+        assert db.query_cache_stats()['hits'] == 1
+
+        with mesh.make_context():
+            db.Item.query.get(1).name = 'b'
+            db.session.commit()
+        assert names() == ['b']
+
+
+class TestTiming:
+    """
+    Feature: SQL timing per context
+    """
+
+    @fixture
+    def config(self, tmpdir):
+        return {
+            'DB_DSN': f"sqlite:///{tmpdir.join('primary.db')}",
+            'DB_TIMING': '1',
+        }
+
+    def test_repeated(self, mesh, db, caplog):
+        """Scenario: Repeated statements are reported at teardown"""
+        caplog.set_level(logging.INFO)
+        with mesh.make_context(method='CONSUME', path='/default/item'):
+            for id in range(10):
+                db.Item.query.filter_by(id=id).first()
+        assert '/default/item: 10 queries' in caplog.text
+        assert 'possible N+1, statement ran 10 times' in caplog.text
@@ -0,0 +1,57 @@
+from kombu import Connection, Producer
+from pytest import importorskip
+
+flask = importorskip('flask')
+
+
+def make_mesh(broker, monkeypatch):
+    from mesh.flask import Mesh
+
+    monkeypatch.setenv('AMQP_DSN', broker.dsn)
+    app = flask.Flask(__name__)
+    mesh = Mesh(app)
+    amqp = mesh.init_amqp()
+    consumer = amqp.init_consumer()
+    for name in ('jobs', 'replies'):
+        amqp.make_queue(name=name).declare()
+    consumer.add_queue(amqp.make_queue(name='jobs'))
+    return mesh
+
+
+class TestAppContext:
+    """
+    Feature: Flask application contexts for non-HTTP work
+    """
+
+    def test_consume(self, broker, monkeypatch):
+        """Scenario: Consumers run in app contexts with teardown"""
+        mesh = make_mesh(broker, monkeypatch)
+        amqp = mesh.amqp
+        amqp.max_messages = 1
+        contexts = []
+        teardowns = []
+
+        @mesh.app.teardown_appcontext
+        def teardown(exc):
+            teardowns.append(flask.g.get('job'))
+
+        @amqp.task('job')
+        def job(message):
+            contexts.append(mesh.current_context())
+            flask.g.job = message.payload
+            amqp.session.respond(json=message.payload * 2)
+
+        with Connection(broker.dsn) as connection:
+            Producer(connection.channel()).publish(
+                21, routing_key='jobs', type='job', reply_to='replies',
+                correlation_id='request')
+        amqp.run()
+
+        reply = broker.get('replies')
+        assert isinstance(contexts[0], flask.ctx.AppContext)
+        assert contexts[0].method == 'CONSUME'
+        assert teardowns == [21]
+        assert reply.payload == 42
+        assert reply.properties['correlation_id'] == 'request'
+        assert amqp.pool.in_use == 0
+        assert len(broker.acks) == 1
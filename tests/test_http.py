@@ -1,5 +1,39 @@
+import json
+
 from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from mesh import Mesh
+from pytest import fixture
+from requests.exceptions import InvalidSchema, ReadTimeout, Timeout
+from threading import Thread
+from time import sleep
+
+
+@fixture
+def server():
+    failures = [1]
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            if self.path == '/slow':
+                sleep(0.5)
+            if self.path == '/flaky' and failures[0]:
+                failures[0] -= 1
+                self.send_response(503)
+            else:
+                self.send_response(200)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{server.server_address[1]}'
+    server.shutdown()
+    server.server_close()
 
 
 class TestSession:
@@ -53,3 +87,77 @@ class TestSession:
         with self.http(config) as http:
             response = http.session.get('http://proxy/restricted')
             assert response.status_code == 200
+
+
+class TestPolicies:
+    """
+    Feature: HTTP pools, timeouts and retries
+    """
+
+    def test_timeout(self, server):
+        """Scenario: Requests without a timeout use the configured one"""
+        mesh = Mesh({'HTTP_CONFIG': {'timeout': {'read': 0.1}}})
+        http = mesh.init_http()
+        errors = []
+        with mesh.make_context():
+            try:
+                http.session.get(f'{server}/slow')
+            except ReadTimeout as error:
+                errors.append(error)
+        assert len(errors) == 1
+
+    def test_retries(self, server):
+        """Scenario: Idempotent requests are retried on a host"""
+        mesh = Mesh({'HTTP_CONFIG': {
+            'hosts': {server: {
+                'retries': {'total': 2, 'status_forcelist': [503]},
+                'pool': {'maxsize': 4},
+            }},
+        }})
+        http = mesh.init_http()
+        with mesh.make_context():
+            response = http.session.get(f'{server}/flaky')
+        assert response.status_code == 200
+        pool, = http.stats()[server].values()
+        assert pool['requests'] == 2
+        assert pool['maxsize'] == 4
+
+
+class TestGather:
+    """
+    Feature: Concurrent HTTP requests
+    """
+
+    def test_deadline(self, server):
+        """Scenario: Results keep their order and stragglers time out"""
+        mesh = Mesh({})
+        http = mesh.init_http()
+        requests = [
+            {'url': f'{server}/slow'},
+            {'url': f'{server}/'},
+            {'url': 'ftp://nowhere/'},
+        ]
+        with mesh.make_context():
+            slow, fast, invalid = http.gather(
+                requests, concurrency=3, deadline=0.2)
+        assert isinstance(slow, Timeout)
+        assert fast.status_code == 200
+        assert isinstance(invalid, InvalidSchema)
+
+    def test_spans(self, server, tmpdir):
+        """Scenario: Concurrent requests are children of the caller's span"""
+        path = tmpdir.join('spans.jsonl')
+        mesh = Mesh({'TRACE_SINK': str(path)})
+        tracer = mesh.init_trace()
+        http = mesh.init_http()
+        with mesh.make_context(method='CRON', path='fanout'):
+            with tracer.span('fanout', 'internal'):
+                http.gather([{'url': f'{server}/'}] * 8, concurrency=8)
+        tracer.close()
+
+        spans = [json.loads(line) for line in path.readlines()]
+        parent, = [span for span in spans if span['name'] == 'fanout']
+        requests = [span for span in spans if span['kind'] == 'http']
+        assert len(requests) == 8
+        assert {span['parent_id'] for span in requests} == \
+            {parent['span_id']}
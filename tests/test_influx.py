@@ -0,0 +1,34 @@
+from mesh import Mesh
+
+
+class RecordingClient:
+
+    def __init__(self, failures=0):
+        self.batches = []
+        self.failures = failures
+
+    def write_points(self, points):
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError('Influx is down')
+        self.batches.append(points)
+
+
+class TestInflux:
+    """
+    Feature: Batched Influx writes
+    """
+
+    def test_batches(self):
+        """Scenario: Points are written in batches and flushed on close"""
+        influx = Mesh({
+            'INFLUX_DSN': 'influxdb://localhost:8086/test',
+            'INFLUX_BATCH_SIZE': '2',
+            'INFLUX_RETRY_BACKOFF': '0',
+        }).init_influx()
+        influx.shared_client = RecordingClient(failures=1)
+        for value in range(3):
+            influx.write('requests', {'path': '/'}, {'value': value})
+        influx.close()
+        assert [len(batch) for batch in influx.shared_client.batches] == [2, 1]
+        assert influx.stats()['written'] == 3
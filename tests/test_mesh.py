@@ -0,0 +1,65 @@
+import asyncio
+
+from concurrent.futures import ThreadPoolExecutor
+from mesh import Mesh
+from threading import Barrier
+
+
+class TestContext:
+    """
+    Feature: Current context
+    """
+
+    def test_nested(self):
+        """Scenario: Nested contexts restore the outer context"""
+        mesh = Mesh({})
+        current = [mesh.current_context()]
+        with mesh.make_context(path='outer') as outer:
+            with mesh.make_context(path='inner') as inner:
+                current.append(mesh.current_context())
+            current.append(mesh.current_context())
+        current.append(mesh.current_context())
+        assert current == [None, inner, outer, None]
+
+    def test_teardown(self):
+        """Scenario: Teardown callbacks see their own context"""
+        mesh = Mesh({})
+        paths = []
+
+        @mesh.teardown_context
+        def teardown():
+            paths.append(mesh.current_context().path)
+
+        with mesh.make_context(path='outer'):
+            with mesh.make_context(path='inner'):
+                pass
+        assert paths == ['inner', 'outer']
+
+    def test_threads(self):
+        """Scenario: Contexts in concurrent threads"""
+        mesh = Mesh({})
+
+        def run(path):
+            with mesh.make_context(path=path):
+                barrier.wait()
+                return mesh.current_context().path
+
+        with ThreadPoolExecutor(4) as executor:
+            barrier = Barrier(4)
+            paths = list(executor.map(run, 'abcd'))
+        assert paths == list('abcd')
+
+    def test_tasks(self):
+        """Scenario: Contexts in concurrent asyncio tasks"""
+        mesh = Mesh({})
+
+        async def run(path):
+            with mesh.make_context(path=path):
+                await asyncio.sleep(0)
+                return mesh.current_context().path
+
+        async def main():
+            return await asyncio.gather(*(run(path) for path in 'abcd'))
+
+        assert asyncio.run(main()) == list('abcd')
+
@@ -0,0 +1,82 @@
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, jsonify
+from mesh import Mesh
+from mesh.cron import Interval, Job, Scheduler
+from threading import Thread
+from urllib.request import urlopen
+
+
+class TestMetrics:
+    """
+    Feature: Metrics registry
+    """
+
+    def test_threads(self):
+        """Scenario: Counts from all threads are merged"""
+        registry = Mesh({}).init_metrics()
+        counter = registry.counter('events_total', 'Events', ('kind',))
+        histogram = registry.histogram('latency_seconds', buckets=(0.1, 1))
+
+        def record(index):
+            counter.inc('a')
+            histogram.observe(index % 2)
+
+        with ThreadPoolExecutor(4) as executor:
+            list(executor.map(record, range(100)))
+
+        assert counter.value('a') == 100
+        text = registry.render()
+        assert 'events_total{kind="a"} 100' in text
+        assert 'latency_seconds_bucket{le="0.1"} 50' in text
+        assert 'latency_seconds_count 100' in text
+
+    def test_endpoint(self):
+        """Scenario: Cron jobs are timed and served over HTTP"""
+        mesh = Mesh({'METRICS_PORT': '0'})
+        registry = mesh.init_metrics()
+        job = Job(lambda: None, Interval(1, 'minute'))
+        Scheduler(mesh)._run_job(job, None)
+        port = registry.server.server_address[1]
+        try:
+            text = urlopen(f'http://127.0.0.1:{port}/metrics').read().decode()
+        finally:
+            registry.close()
+        assert 'mesh_cron_job_seconds_count{job="<lambda>",status="ok"} 1' \
+            in text
+
+    def test_finished_threads(self):
+        """Scenario: Shards of finished threads are folded into a total"""
+        counter = Mesh({}).init_metrics().counter('events_total')
+        for __ in range(10):
+            thread = Thread(target=counter.inc)
+            thread.start()
+            thread.join()
+        assert counter.value() == 10
+        assert counter.shards == []
+        counter.inc()
+        assert counter.value() == 11
+
+    def test_endpoint_status(self):
+        """Scenario: JSON endpoints returning headers are timed as 200"""
+        mesh = Mesh({})
+        registry = mesh.init_metrics()
+        http = mesh.init_http()
+        app = Flask(__name__)
+
+        @app.route('/created')
+        @http.json_endpoint
+        def created():
+            return jsonify(id=1), 201
+
+        @app.route('/tagged')
+        @http.json_endpoint
+        def tagged():
+            return jsonify(id=1), {'X-Tag': 'a'}
+
+        client = app.test_client()
+        assert client.get('/created').status_code == 201
+        assert client.get('/tagged').headers['X-Tag'] == 'a'
+        histogram = registry.metrics['mesh_http_request_seconds']
+        statuses = {labels[1] for shard in histogram.collect()
+                    for labels in shard}
+        assert statuses == {201, 200}
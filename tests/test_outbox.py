@@ -0,0 +1,88 @@
+import logging
+
+from mesh import Mesh
+from mesh.amqp import Session
+from pytest import fixture
+from sqlalchemy import event
+from time import monotonic, sleep
+
+
+@fixture
+def mesh(broker, tmpdir):
+    mesh = Mesh({
+        'AMQP_DSN': broker.dsn,
+        'AMQP_OUTBOX': '1',
+        'AMQP_OUTBOX_INTERVAL': '0.05',
+        'DB_DSN': f"sqlite:///{tmpdir.join('outbox.db')}",
+    })
+    mesh.init_amqp().make_queue(name='jobs').declare()
+    yield mesh
+    mesh.amqp.close()
+
+
+def receive(broker, queue, timeout=2):
+    deadline = monotonic() + timeout
+    while monotonic() < deadline:
+        message = broker.get(queue)
+        if message is not None:
+            return message
+        sleep(0.01)
+
+
+class TestOutbox:
+    """
+    Feature: Transactional outbox
+    """
+
+    def test_relay(self, mesh, broker):
+        """Scenario: Messages are stored in the DB transaction and relayed"""
+        amqp, db = mesh.amqp, mesh.db
+        staged = []
+
+        @event.listens_for(db.session, 'before_commit')
+        def before_commit(session):
+            staged.extend(
+                row.message['body']
+                for row in session.execute(amqp.outbox.table.select()))
+
+        with mesh.make_context():
+            amqp.session.add(routing_key='jobs', json='relayed')
+            amqp.session.commit()
+
+        message = receive(broker, 'jobs')
+        # Rows are deleted once the broker confirmed the messages.
+        deadline = monotonic() + 2
+        while monotonic() < deadline:
+            with db.engine.connect() as connection:
+                remaining = connection.execute(
+                    amqp.outbox.table.select()).fetchall()
+            if not remaining:
+                break
+            sleep(0.01)
+        assert staged == ['"relayed"']
+        assert message.payload == 'relayed'
+        assert remaining == []
+
+    def test_direct_reply(self, mesh):
+        """Scenario: Requests with direct replies are refused"""
+        amqp = mesh.amqp
+        errors = []
+        with mesh.make_context():
+            amqp.session.add(routing_key='jobs', reply_to=Session.reply_queue)
+            try:
+                amqp.session.commit()
+            except ValueError as error:
+                errors.append(error)
+        assert len(errors) == 1
+
+    def test_failure(self, mesh, caplog):
+        """Scenario: The relay backs off after errors and keeps running"""
+        caplog.set_level(logging.ERROR)
+        outbox = mesh.amqp.outbox
+        outbox.table.drop(mesh.db.engine)
+        outbox.start()
+        sleep(0.5)
+        # Retries after 0.1, 0.2 and 0.4 seconds.
+        assert outbox.thread.is_alive()
+        assert 2 <= len(caplog.records) <= 4
+        assert 'no such table' in caplog.text
@@ -0,0 +1,49 @@
+from mesh import Mesh
+from time import sleep
+
+
+def busy(seconds):
+    sleep(seconds)
+
+
+class TestProfiler:
+    """
+    Feature: Profiling slow contexts
+    """
+
+    def test_every(self):
+        """Scenario: Every Nth context is profiled"""
+        profiler = Mesh({'PROFILE_EVERY': '2'}).init_profiler()
+        for index in range(4):
+            with profiler.mesh.make_context(method='CRON', path='job'):
+                busy(0.001)
+        profiles = profiler.profiles()['CRON job']
+        assert len(profiles) == 2
+        assert 'busy' in profiles[0][2]
+
+    def test_threshold(self, tmpdir):
+        """Scenario: Only contexts over the threshold are sampled"""
+        profiler = Mesh({
+            'PROFILE_THRESHOLD': '20',
+            'PROFILE_INTERVAL': '5',
+        }).init_profiler()
+        with profiler.mesh.make_context(method='CRON', path='fast'):
+            pass
+        with profiler.mesh.make_context(method='CRON', path='slow'):
+            busy(0.1)
+        assert list(profiler.profiles()) == ['CRON slow']
+        profiler.dump(str(tmpdir))
+        text = tmpdir.join('CRON_slow-1.txt').read()
+        assert 'busy (test_profiler.py' in text
+
+    def test_nested(self):
+        """Scenario: A nested context does not end sampling of the outer"""
+        profiler = Mesh({
+            'PROFILE_THRESHOLD': '20',
+            'PROFILE_INTERVAL': '5',
+        }).init_profiler()
+        with profiler.mesh.make_context(method='CRON', path='outer'):
+            with profiler.mesh.make_context(method='CRON', path='inner'):
+                pass
+            busy(0.1)
+        assert list(profiler.profiles()) == ['CRON outer']
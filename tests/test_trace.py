@@ -0,0 +1,64 @@
+import json
+
+from mesh import Mesh
+
+
+class TestTrace:
+    """
+    Feature: Context tracing
+    """
+
+    def test_propagation(self, tmpdir):
+        """Scenario: Spans of a downstream context join the caller's trace"""
+        path = tmpdir.join('spans.jsonl')
+        mesh = Mesh({
+            'TRACE_SINK': str(path),
+            'DB_DSN': f"sqlite:///{tmpdir.join('db.sqlite')}",
+        })
+        tracer = mesh.init_trace()
+        db = mesh.init_db()
+
+        with mesh.make_context(method='CRON', path='caller'):
+            db.session.execute(db.text('SELECT 1'))
+            with tracer.span('call', 'http'):
+                headers = tracer.inject({})
+        with mesh.make_context(method='CONSUME', path='/callee',
+                               headers=headers):
+            pass
+        tracer.close()
+
+        spans = {}
+        for line in path.readlines():
+            span = json.loads(line)
+            spans[span['name']] = span
+        caller = spans['CRON caller']
+        assert spans['SELECT']['parent_id'] == caller['span_id']
+        assert spans['call']['parent_id'] == caller['span_id']
+        assert spans['CONSUME /callee']['trace_id'] == caller['trace_id']
+        assert spans['CONSUME /callee']['parent_id'] == \
+            spans['call']['span_id']
+
+    def test_nested(self, tmpdir):
+        """Scenario: A nested context is a child of the outer context"""
+        path = tmpdir.join('spans.jsonl')
+        mesh = Mesh({'TRACE_SINK': str(path)})
+        tracer = mesh.init_trace()
+
+        with mesh.make_context(method='CRON', path='outer'):
+            with mesh.make_context(method='CONSUME', path='/inner'):
+                with tracer.span('call', 'http'):
+                    pass
+            with tracer.span('after', 'http'):
+                pass
+        tracer.close()
+
+        spans = {}
+        for line in path.readlines():
+            span = json.loads(line)
+            spans[span['name']] = span
+        outer, inner = spans['CRON outer'], spans['CONSUME /inner']
+        assert outer['parent_id'] is None
+        assert inner['trace_id'] == outer['trace_id']
+        assert inner['parent_id'] == outer['span_id']
+        assert spans['call']['parent_id'] == inner['span_id']
+        assert spans['after']['parent_id'] == outer['span_id']
@@ -0,0 +1,137 @@
+import os
+import socket
+
+from mesh import Mesh
+from mesh.worker import Supervisor, start
+from pytest import fixture
+from signal import SIGINT, SIGTERM, getsignal, signal
+from threading import Timer
+from time import monotonic, sleep
+from urllib.request import urlopen
+
+
+@fixture
+def handlers():
+    # The supervisor installs signal handlers in the test process.
+    handlers = {signo: getsignal(signo) for signo in (SIGINT, SIGTERM)}
+    yield
+    for signo, handler in handlers.items():
+        signal(signo, handler)
+
+
+def wait(supervisor, timeout=5):
+    deadline = monotonic() + timeout
+    while supervisor.children and monotonic() < deadline:
+        supervisor.reap()
+        sleep(0.01)
+
+
+class TestSupervisor:
+    """
+    Feature: Worker process supervisor
+    """
+
+    def test_close(self, tmpdir):
+        """Scenario: Workers close the mesh before they exit"""
+        mesh = Mesh({
+            'PROFILE_EVERY': '1',
+            'PROFILE_DIR': str(tmpdir.join('profiles')),
+        })
+        mesh.init_profiler()
+
+        def target():
+            with mesh.make_context(method='CRON', path='/job'):
+                sum(range(1000))
+
+        supervisor = Supervisor(mesh, target, processes=1)
+        supervisor.spawn()
+        wait(supervisor)
+        assert supervisor.children == {}
+        assert tmpdir.join('profiles').listdir()
+
+    def test_metrics(self):
+        """Scenario: Workers serve their metrics on their own ports"""
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            port = sock.getsockname()[1]
+        mesh = Mesh({'METRICS_PORT': str(port)})
+        mesh.init_metrics()
+
+        def target():
+            mesh.metrics.counter('jobs_total').inc()
+            sleep(10)
+
+        supervisor = Supervisor(mesh, target, processes=1)
+        supervisor.spawn()
+        body = ''
+        deadline = monotonic() + 5
+        while 'jobs_total 1' not in body and monotonic() < deadline:
+            try:
+                with urlopen(f'http://127.0.0.1:{port + 1}/') as response:
+                    body = response.read().decode()
+            except OSError:
+                sleep(0.05)
+        with urlopen(f'http://127.0.0.1:{port}/') as response:
+            parent = response.read().decode()
+        supervisor.shutdown()
+        mesh.metrics.close()
+        assert 'jobs_total 1' in body
+        assert 'jobs_total' not in parent
+
+    def test_replace(self, tmpdir, handlers):
+        """Scenario: Workers which exit are replaced"""
+        started = tmpdir.mkdir('started')
+
+        def target():
+            started.join(str(os.getpid())).write('')
+
+        supervisor = Supervisor(Mesh({}), target, processes=2)
+        Timer(1.2, supervisor.stop).start()
+        supervisor.run()
+        assert supervisor.children == {}
+        assert len(started.listdir()) > 2
+
+    def test_shutdown(self, tmpdir, handlers):
+        """Scenario: Workers are terminated when the supervisor stops"""
+        started = tmpdir.mkdir('started')
+
+        def target():
+            started.join(str(os.getpid())).write('')
+            sleep(10)
+
+        supervisor = Supervisor(
+            Mesh({}), target, processes=2, shutdown_timeout=2)
+        Timer(0.5, supervisor.stop).start()
+        began = monotonic()
+        supervisor.run()
+        assert supervisor.children == {}
+        assert len(started.listdir()) == 2
+        assert monotonic() - began < 5
+
+    def test_failure(self):
+        """Scenario: Failing workers exit with an error status"""
+        def target():
+            raise ValueError('Failed')
+
+        supervisor = Supervisor(Mesh({}), target, processes=1)
+        supervisor.spawn()
+        (pid,) = supervisor.children
+        __, status = os.waitpid(pid, 0)
+        assert os.WEXITSTATUS(status) == 1
+
+
+class TestStart:
+    """
+    Feature: Worker entry point
+    """
+
+    def test_coroutine(self):
+        """Scenario: Coroutine functions run in an event loop"""
+        calls = []
+
+        async def run():
+            calls.append('async')
+
+        start(run)
+        start(lambda: calls.append('sync'))
+        assert calls == ['async', 'sync']